@@ -1,7 +1,13 @@
 " init "
 from .version import __version__
 from .aioheoscontroller import AioHeosController, AioHeosException, SOURCE_LIST
+from .aioheoscontroller import (PRIORITY_INTERACTIVE, PRIORITY_NORMAL,
+                                PRIORITY_BACKGROUND)
+from .aioheosmanager import AioHeosManager
+from .aioheosproxy import AioHeosProxy
 from .aioheosupnp import AioHeosUpnp
+from .aioheosmessage import HeosMessage
+from .aioheosevents import AioHeosEventStream
 from .aioheosplayer import AioHeosPlayer
 from .aioheosgroup import AioHeosGroup
 
@@ -2,11 +2,17 @@
 """Heos python lib."""
 
 import asyncio
-import json
+import collections
+import functools
+import itertools
 import logging
+import random
 from concurrent.futures import CancelledError
+from urllib.parse import quote
 
+from . import aioheosevents
 from . import aioheosgroup
+from . import aioheosmessage
 from . import aioheosplayer
 from . import aioheosupnp
 
@@ -14,6 +20,13 @@ _LOGGER = logging.getLogger(__name__)
 
 HEOS_PORT = 1255
 
+# reconnect backoff bounds in seconds
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# lines read on one connection before letting the others read
+READ_SLICE = 16
+
 GET_PLAYERS = 'player/get_players'
 GET_PLAYER_INFO = 'player/get_player_info'
 GET_PLAY_STATE = 'player/get_play_state'
@@ -53,6 +66,7 @@ SYSTEM_PRETTIFY = 'system/prettify_json_response'
 SYSTEM_REGISTER_FOR_EVENTS = 'system/register_for_change_events'
 SYSTEM_SIGNIN = 'system/sign_in'
 SYSTEM_SIGNOUT = 'system/sign_out'
+SYSTEM_HEART_BEAT = 'system/heart_beat'
 
 BROWSE_MUSIC_SOURCES = 'browse/get_music_sources'
 BROWSE_SEARCH = 'browse/search'
@@ -60,6 +74,50 @@ BROWSE_BROWSE = 'browse/browse'
 BROWSE_SEARCH_CRITERIA = 'browse/get_search_criteria'
 BROWSE_PLAY_STREAM = 'browse/play_stream'
 
+# encoded prefixes of command lines
+_COMMAND_PREFIXES = {}
+# argument echoed by the device in the reply, pairing it with the command
+SEQUENCE = 'SEQUENCE'
+# printable ascii except the characters with meaning in a command line
+_SAFE = ''.join(chr(char) for char in range(32, 127) if chr(char) not in '&=%')
+
+# fields for AioHeosController.refresh
+REFRESH_FIELDS = {
+    'play_state': GET_PLAY_STATE,
+    'mute': GET_MUTE_STATE,
+    'volume': GET_VOLUME,
+    'now_playing': GET_NOW_PLAYING_MEDIA,
+}
+
+# command priorities, lower goes first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND)
+
+# priority of commands not sent with an explicit one, others are normal
+COMMAND_PRIORITIES = {
+    SET_PLAY_STATE: PRIORITY_INTERACTIVE,
+    SET_VOLUME: PRIORITY_INTERACTIVE,
+    SET_MUTE_STATE: PRIORITY_INTERACTIVE,
+    TOGGLE_MUTE: PRIORITY_INTERACTIVE,
+    PLAY_NEXT: PRIORITY_INTERACTIVE,
+    PLAY_PREVIOUS: PRIORITY_INTERACTIVE,
+    PLAY_QUEUE: PRIORITY_INTERACTIVE,
+    BROWSE_PLAY_STREAM: PRIORITY_INTERACTIVE,
+    SET_GROUP: PRIORITY_INTERACTIVE,
+    GET_QUEUE: PRIORITY_BACKGROUND,
+    BROWSE_BROWSE: PRIORITY_BACKGROUND,
+    BROWSE_SEARCH: PRIORITY_BACKGROUND,
+    BROWSE_SEARCH_CRITERIA: PRIORITY_BACKGROUND,
+    BROWSE_MUSIC_SOURCES: PRIORITY_BACKGROUND,
+}
+
+COMMANDS_IGNORED = frozenset(
+    (SYSTEM_PRETTIFY, SYSTEM_REGISTER_FOR_EVENTS, EVENT_PLAYER_QUEUE_CHANGED,
+     EVENT_SOURCES_CHANGED, EVENT_USER_CHANGED, EVENT_SHUTTLE_MODE_CHANGED,
+     EVENT_REPEAT_MODE_CHANGED))
+
 SOURCE_LIST = {
     1: 'Pandora',
     2: 'Rhapsody',
@@ -81,15 +139,130 @@ SOURCE_LIST = {
 
 
 class AioHeosException(Exception):
-    """AioHeosException class."""
+    """AioHeosException class.
+
+    record is the HeosMessage of the device reporting the error, if any.
+    """
+
+    record = None
 
     # pylint: disable=super-init-not-called
     def __init__(self, message):
         self.message = message
 
 
+def _chain_future(source, destination):
+    """Copy the outcome of source to destination once done."""
+
+    def copy(_future):
+        if destination.done():
+            return
+        if source.cancelled():
+            destination.cancel()
+        elif source.exception() is not None:
+            destination.set_exception(source.exception())
+        else:
+            destination.set_result(source.result())
+
+    source.add_done_callback(copy)
+
+
+class _PendingCommand:
+    """Command waiting to be written or for its reply.
+
+    Replies are paired with commands by sequence, or by key for replies
+    without one. A command written but not answered yet when it expires
+    or is cancelled stays pending for another timeout, so its late reply
+    is not taken for the one of a newer command with the same key.
+    """
+
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, key, sequence, data, future, timeout, retries,
+                 pinned=None):
+        self.key = key
+        self.sequence = sequence
+        self.data = data
+        self.future = future
+        self.timeout = timeout
+        self.retries = retries
+        self.pinned = pinned
+        self.connection = None
+        self.sent = False
+        self.under_process = False
+        self.deadline = None
+        # replies still to come, one per write
+        self.replies_due = 0
+
+
+class _TokenBucket:
+    """Allow rate commands per second, with bursts of up to burst."""
+
+    def __init__(self, rate, burst=None):
+        self._rate = rate
+        self._burst = burst or max(1, rate)
+        self._tokens = self._burst
+        self._stamp = None
+
+    def delay(self, now):
+        """Seconds until a command may be sent, 0 if right away."""
+        if self._stamp is not None:
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._stamp) * self._rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def take(self):
+        """Count a command as sent."""
+        self._tokens -= 1
+
+
+class _HeosConnection:
+    """One CLI connection, carrying events, commands or both."""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, name, events):
+        self.name = name
+        self.events = events
+        self.reader = None
+        self.writer = None
+        self.in_flight = 0
+        self.outbox = collections.deque()
+        self.task = None
+        self.missed = 0
+
+
 class AioHeosController:
-    """Asynchronous Heos class."""
+    """Asynchronous Heos class.
+
+    Commands are sent by priority, see COMMAND_PRIORITIES: interactive
+    ones first, then normal ones, then background ones, which include
+    refreshes.
+
+    host: device to connect to, discovered if None.
+    max_in_flight: commands outstanding per connection at most.
+    command_timeout: seconds to answer a command in, from being queued.
+    command_connections: connections commands are sent on, each on the
+        least busy one, so replies do not queue behind events. With 0
+        they share the connection events are received on.
+    background_share: part of the in-flight window background commands
+        use at most, so interactive ones always find room.
+    rate_limits: maximum commands per second by priority.
+    discovery_cache: aioheosupnp.DiscoveryCache instead of the shared one.
+    description_cache: aioheosupnp.DescriptionCache instead of the shared
+        one.
+    ssdp_listen: listen for device announcements, players leaving are
+        marked offline right away, players arriving are refreshed and a
+        connection waiting to be retried is retried at once.
+    progress_resync: progress events only notify listeners on seeks,
+        track changes or every progress_resync seconds, see
+        AioHeosPlayer.estimated_position.
+    refresh_settle: seconds refreshes triggered by events wait for
+        further events before they are sent.
+    heartbeat_interval: seconds between heart beats, the connection is
+        reestablished after heartbeat_misses unanswered beats.
+    """
 
     # ddpylint: disable=too-many-public-methods,too-many-instance-attributes
     def __init__(self,
@@ -98,7 +271,20 @@ class AioHeosController:
                  username=None,
                  password=None,
                  new_device_callback=None,
-                 port=HEOS_PORT):
+                 port=HEOS_PORT,
+                 max_in_flight=4,
+                 command_timeout=10,
+                 command_retries=1,
+                 progress_resync=None,
+                 refresh_settle=0,
+                 heartbeat_interval=None,
+                 heartbeat_misses=3,
+                 command_connections=0,
+                 background_share=0.5,
+                 rate_limits=None,
+                 discovery_cache=None,
+                 ssdp_listen=False,
+                 description_cache=None):
         self._host = host
         self._port = port
         self._loop = loop
@@ -108,51 +294,141 @@ class AioHeosController:
         self._new_device_callback = new_device_callback
         self._players = None
         self._groups = None
+        self._player_index = {}
+        self._group_index = {}
+        self._player_group_index = {}
+        self._pending = {}
+        self._sequences = {}
+        self._sequence = itertools.count(1)
+        self._outboxes = [collections.deque() for _ in PRIORITIES]
+        self._max_in_flight = max_in_flight
+        self._background_slots = max(1, min(max_in_flight - 1,
+                                            int(max_in_flight *
+                                                background_share)))
+        self._buckets = {
+            priority: _TokenBucket(rate)
+            for priority, rate in (rate_limits or {}).items()
+        }
+        self._send_timer = None
+        self._command_timeout = command_timeout
+        self._command_retries = command_retries
+        self._progress_resync = progress_resync
+        self._refresh_settle = refresh_settle
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_misses = heartbeat_misses
+        self._heartbeat_task = None
+        self._rtt = None
+        self._rtt_smoothed = None
+        self._reconnects = 0
+        self._settling = {}
+        self._send_wakeup = asyncio.Event()
+        self._send_task = None
 
         self._upnp = None
-        self._reader = None
-        self._writer = None
-        self._subscribtion_task = None
+        self._discovery_cache = discovery_cache
+        self._description_cache = description_cache
+        self._ssdp_listen = ssdp_listen
+        self._ssdp_listener = None
+        self._connect_now = asyncio.Event()
+        # addresses of host, as devices announce themselves
+        self._addresses = set()
+        self._event_connection = _HeosConnection('events', True)
+        self._command_connections = [
+            _HeosConnection('commands {}'.format(index), False)
+            for index in range(command_connections)
+        ]
+        self._connections = [self._event_connection]
+        self._connections.extend(self._command_connections)
+        if not self._command_connections:
+            # one connection for everything
+            self._command_connections = [self._event_connection]
+        self._resync_task = None
         self._close_requested = False
 
+        self._callback = None
+        self._coalesce = None
+        self._changed = set()
+        self._flush_handle = None
+        self._event_streams = []
+
         self._favourites = []
         self._favourites_sid = None
+        self._favourites_loaded = self._loop.create_future()
         self._music_sources = {}
 
+        self._handlers = {
+            GET_PLAYERS:
+            self._parse_players,
+            GET_GROUPS:
+            self._parse_groups,
+            SET_GROUP:
+            self._parse_set_group,
+            GET_PLAY_STATE:
+            self._parse_play_state,
+            SET_PLAY_STATE:
+            self._parse_play_state,
+            GET_MUTE_STATE:
+            self._parse_mute_state,
+            SET_MUTE_STATE:
+            self._parse_mute_state,
+            GET_VOLUME:
+            self._parse_volume,
+            SET_VOLUME:
+            self._parse_volume,
+            GET_NOW_PLAYING_MEDIA:
+            self._parse_now_playing_media,
+            EVENT_PLAYER_VOLUME_CHANGED:
+            self._parse_player_volume_changed,
+            EVENT_GROUP_VOLUME_CHANGED:
+            self._parse_group_volume_changed,
+            EVENT_PLAYER_STATE_CHANGED:
+            self._parse_player_state_changed,
+            EVENT_PLAYERS_CHANGED:
+            self._parse_players_changed,
+            EVENT_PLAYER_NOW_PLAYING_CHANGED:
+            self._parse_player_now_playing_changed,
+            EVENT_PLAYER_NOW_PLAYING_PROGRESS:
+            self._parse_player_now_playing_progress,
+            EVENT_GROUPS_CHANGED:
+            self._parse_groups_changed,
+            SYSTEM_SIGNIN:
+            self._parse_system_signin,
+            BROWSE_MUSIC_SOURCES:
+            self._parse_browse_music_source,
+            BROWSE_BROWSE:
+            self._parse_browse_browse,
+        }
+
+    @staticmethod
+    async def _await_reply(future, timeout):
+        """Wait for a reply, log instead of raise on timeout or failure."""
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            _LOGGER.warning('[W] No reply within %s seconds', timeout)
+        except AioHeosException as exc:
+            _LOGGER.warning('[W] %s', exc.message)
+        return None
+
     async def ensure_player(self):
         """Ensure player."""
         # timeout after 10 sec
-        self.request_players()
-        for _ in range(0, 20):
-            if self._players:
-                return
-            await asyncio.sleep(0.5)
+        await self._await_reply(self.request_players(), 10)
 
     async def ensure_group(self):
         """Ensure group."""
         # timeout after 10 sec
-        self.request_groups()
-        for _ in range(0, 20):
-            if self._groups is not None:
-                return
-            await asyncio.sleep(0.5)
+        await self._await_reply(self.request_groups(), 10)
 
     async def ensure_login(self):
         """Ensure login."""
         # timeout after 20 sec
-        self.login()
-        for _ in range(0, 20):
-            if not self._need_login:
-                return
-            await asyncio.sleep(0.5)
+        await self._await_reply(self.login(), 20)
 
     async def ensure_favourites_loaded(self):
         """Ensure favourites loaded."""
         # timeout after 20 sec
-        for _ in range(0, 20):
-            if self._favourites:
-                return
-            await asyncio.sleep(0.5)
+        await self._await_reply(asyncio.shield(self._favourites_loaded), 20)
 
     @staticmethod
     def _url_to_addr(url):
@@ -162,28 +438,55 @@ class AioHeosController:
             return addr.group(1)
         return None
 
-    async def connect(self, callback=None):
-        """Connect to device."""
+    async def connect(self, callback=None, coalesce=None):
+        """Connect to device.
+
+        By default the async callback is called without arguments for every
+        message received. With coalesce set to a number of seconds, or 0 for
+        one event loop tick, all state changes within that window are
+        collapsed into one call of callback(changed), where changed is the
+        set of players and groups whose state changed.
+        """
+        self._callback = callback
+        self._coalesce = coalesce
         if not self._host:
             # discover
-            if not self._upnp:
-                self._upnp = aioheosupnp.AioHeosUpnp(loop=self._loop)
-            url = await self._upnp.discover()
+            url = await self._get_upnp().discover()
             self._host = self._url_to_addr(url)
 
+        if self._ssdp_listen and not self._ssdp_listener:
+            self._addresses = await aioheosupnp.resolve(self._loop,
+                                                        self._host)
+            try:
+                self._ssdp_listener = await aioheosupnp.Upnp(
+                    self._loop).listen(
+                        self._device_arrived,
+                        self._device_departed,
+                        descriptions=self._get_upnp().descriptions)
+            except OSError as exc:
+                _LOGGER.warning('[W] Unable to listen for devices: %s', exc)
+
         # connect
         _LOGGER.debug('[I] Connecting to %s:%s', self._host, self._port)
-        await self._connect()
+        await asyncio.gather(*(self._connect(connection)
+                               for connection in self._connections))
 
-        # please, do not prettify json
-        self.register_pretty_json(False)
-        # and get events
-        self.register_for_change_events()
+        if not self._send_task:
+            self._send_task = self._loop.create_task(self._async_send())
+
+        for connection in self._connections:
+            self._setup_session(connection)
+
+        # setup subscription loops
+        for connection in self._connections:
+            if not connection.task:
+                connection.task = self._loop.create_task(
+                    self._async_subscribe(
+                        connection, callback if coalesce is None else None))
 
-        # setup subscription loop
-        if not self._subscribtion_task:
-            self._subscribtion_task = self._loop.create_task(
-                self._async_subscribe(callback))
+        if self._heartbeat_interval and not self._heartbeat_task:
+            self._heartbeat_task = self._loop.create_task(
+                self._async_heartbeat())
 
         # request for players
         await self.ensure_player()
@@ -192,176 +495,629 @@ class AioHeosController:
             await self.ensure_login()
             self.request_music_sources()
 
-    async def _connect(self):
-        """Connect."""
+    async def _connect(self, connection):
+        """Connect, retry with jittered exponential backoff."""
+        attempt = 0
         while not self._close_requested:
-            wait = 5
             try:
-                # pylint: disable=line-too-long
-                self._reader, self._writer = await asyncio.open_connection(
-                    self._host, self._port, loop=self._loop)
+                connection.reader, connection.writer = (
+                    await asyncio.open_connection(self._host, self._port))
                 return
             except TimeoutError:
-                _LOGGER.warning('[W] Connection timed out'
-                                ', will try %s:%s again in %d seconds ...',
-                                self._host, self._port, wait)
+                reason = 'timed out'
             except ConnectionRefusedError:
-                wait = 30
-                _LOGGER.warning('[W] Connection refused'
-                                ', will try %s:%s again in %d seconds ...',
-                                self._host, self._port, wait)
+                reason = 'refused'
             except Exception as exc:  # pylint: disable=broad-except
-                _LOGGER.error('[E] %s', exc)
+                reason = 'failed, {}'.format(exc)
+
+            wait = random.uniform(
+                RECONNECT_MIN_DELAY,
+                min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2**attempt))
+            attempt += 1
+            _LOGGER.warning('[W] Connection for %s %s'
+                            ', will try %s:%s again in %.1f seconds ...',
+                            connection.name, reason, self._host, self._port,
+                            wait)
+            self._connect_now.clear()
+            try:
+                # unless the device announces itself before
+                await asyncio.wait_for(self._connect_now.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
 
-            await asyncio.sleep(wait)
+    def _player_at(self, host):
+        """Player with ip address host."""
+        for player in self._player_index.values():
+            if player.ip_address == host:
+                return player
+        return None
+
+    def _device_arrived(self, device):
+        """Device announced itself."""
+        if device.host in self._addresses:
+            self._connect_now.set()
+        player = self._player_at(device.host)
+        if player is None:
+            # other renderers announce themselves as media renderers too
+            if device.search_target == aioheosupnp.DENON_DEVICE:
+                self._request_refresh(GET_PLAYERS)
+        elif not player.online:
+            self._loop.create_task(self.refresh([player.player_id]))
+
+    def _device_departed(self, device):
+        """Device said goodbye or stopped announcing itself."""
+        player = self._player_at(device.host)
+        if player is not None:
+            # Make player offline
+            player.play_state = None
+
+    @property
+    def host(self):
+        """Host of the device connected to."""
+        return self._host
+
+    def stats(self):
+        """Connection statistics."""
+        return {
+            'host': self._host,
+            'connected': all(connection.writer
+                             for connection in self._connections),
+            'reconnects': self._reconnects,
+            'in_flight': sum(connection.in_flight
+                             for connection in self._connections),
+            'queued': sum(len(outbox) for outbox in self._outboxes) + sum(
+                len(connection.outbox) for connection in self._connections),
+            'rtt': self._rtt,
+            'rtt_smoothed': self._rtt_smoothed,
+        }
+
+    @property
+    def rtt(self):
+        """Round trip time of the last heart beat in seconds."""
+        return self._rtt
+
+    @property
+    def rtt_smoothed(self):
+        """Smoothed heart beat round trip time in seconds."""
+        return self._rtt_smoothed
+
+    async def _async_heartbeat(self):
+        """Send heart beats on every connection, every interval."""
+        interval = self._heartbeat_interval
+        beat = self._loop.time()
+        while not self._close_requested:
+            try:
+                # a beat is answered or missed within interval, so waiting
+                # for it does not stretch the period
+                beat = max(beat + interval, self._loop.time())
+                await asyncio.sleep(beat - self._loop.time())
+                await asyncio.gather(*(self._heart_beat(connection)
+                                       for connection in self._connections))
+            except (GeneratorExit, CancelledError):
+                return
 
-    def send_command(self, command, message=None):
-        """Send command."""
-        msg = 'heos://' + command
+    async def _heart_beat(self, connection):
+        """Send one heart beat, reconnect when too many are missed."""
+        if not connection.writer:
+            # reconnecting
+            connection.missed = 0
+            return
+        start = self._loop.time()
+        try:
+            await self._send_on(connection, SYSTEM_HEART_BEAT,
+                                timeout=self._heartbeat_interval)
+        except AioHeosException:
+            connection.missed += 1
+            _LOGGER.debug('[D] Missed heart beat %d on %s', connection.missed,
+                          connection.name)
+            if connection.missed >= self._heartbeat_misses \
+                    and connection.writer:
+                _LOGGER.warning('[W] %d heart beats missed on %s, '
+                                'try to reconnect...', connection.missed,
+                                connection.name)
+                connection.missed = 0
+                # readline sees EOF, which reconnects
+                connection.writer.transport.abort()
+            return
+        connection.missed = 0
+        if not connection.events:
+            return
+        self._rtt = self._loop.time() - start
+        if self._rtt_smoothed is None:
+            self._rtt_smoothed = self._rtt
+        else:
+            self._rtt_smoothed += (self._rtt - self._rtt_smoothed) / 8
+
+    def _setup_session(self, connection, login=False):
+        """Queue session setup ahead of commands queued for connection."""
+        queued = len(connection.outbox)
+        # please, do not prettify json
+        self._send_on(connection, SYSTEM_PRETTIFY, {'enable': 'off'})
+        if connection.events:
+            # and get events
+            self._send_on(connection, SYSTEM_REGISTER_FOR_EVENTS,
+                          {'enable': 'on'})
+            if login:
+                self._send_on(connection, SYSTEM_SIGNIN, {
+                    'un': self._username,
+                    'pw': self._password
+                })
+        connection.outbox.rotate(len(connection.outbox) - queued)
+
+    async def _reconnect(self, connection):
+        """Reconnect, replay the session setup and resync state."""
+        if connection.writer:
+            connection.writer.close()
+            connection.writer = None
+        # replies to commands written on the lost connection never arrive
+        for queue in list(self._pending.values()):
+            for cmd in list(queue):
+                if cmd.connection is not connection:
+                    continue
+                cmd.replies_due = 0
+                if cmd.future.done():
+                    self._forget_command(cmd)
+                else:
+                    cmd.future.set_exception(
+                        AioHeosException('Connection lost'))
+
+        await self._connect(connection)
+        if self._close_requested:
+            return
+        self._reconnects += 1
+        _LOGGER.info('[I] Reconnected %s to %s:%s', connection.name,
+                     self._host, self._port)
+        self._setup_session(connection, login=bool(self._username))
+        self._send_wakeup.set()
+        if not connection.events:
+            return
+        if self._resync_task:
+            self._resync_task.cancel()
+        self._resync_task = self._loop.create_task(self._resync())
+
+    async def _resync(self):
+        """Fetch fresh state after reconnect.
+
+        Players and groups are fetched in parallel and applied over the
+        cached state; as unchanged values are skipped, listeners only hear
+        about what changed while disconnected.
+        """
+        try:
+            players, _ = await asyncio.gather(
+                self.send_command(GET_PLAYERS, priority=PRIORITY_BACKGROUND),
+                self.send_command(GET_GROUPS, priority=PRIORITY_BACKGROUND))
+            current = {str(player['pid']) for player in players.payload or ()}
+            for pid, player in self._player_index.items():
+                if pid not in current:
+                    # Make player offline
+                    player.play_state = None
+            failures = await self.refresh(current)
+            for pid, exc in failures.items():
+                _LOGGER.warning('[W] Resync of %s failed: %s', pid,
+                                exc.message)
+        except AioHeosException as exc:
+            _LOGGER.warning('[W] Resync failed: %s', exc.message)
+
+    @staticmethod
+    def _command_key(command, message):
+        """Key used to pair a command with its reply."""
+        pid = None
         if message:
-            msg += '?' + '&'.join("{}={}".format(key, val)
-                                  for (key, val) in message.items())
-        msg += '\r\n'
-        _LOGGER.debug(msg)
-        self._writer.write(msg.encode('ascii'))
+            pid = message.get('pid', message.get('gid'))
+        return (command, None if pid is None else str(pid))
+
+    @staticmethod
+    def _encode_command(command, message, sequence):
+        """Encode command line, percent-encoding the values."""
+        prefix = _COMMAND_PREFIXES.get(command)
+        if prefix is None:
+            prefix = _COMMAND_PREFIXES.setdefault(
+                command, 'heos://{}?'.format(command).encode('ascii'))
+        arguments = ''.join(key + '=' + quote(str(val), _SAFE) + '&'
+                            for (key, val) in (message or {}).items())
+        return prefix + (arguments + SEQUENCE + '=' +
+                         str(sequence)).encode('ascii') + b'\r\n'
+
+    def send_command(self, command, message=None, timeout=None,
+                     coalesce=False, priority=None):
+        """Send command.
+
+        The command is queued and written once the in-flight window has
+        room. Returns a future which is resolved with the HeosMessage
+        reply of the device, or fails with AioHeosException if the device
+        reports an error or does not answer within the deadline.
+
+        With coalesce, for idempotent set commands, a queued command with
+        the same command and pid which is not written yet takes the new
+        value instead, and its future is returned.
+
+        priority is one of PRIORITIES, by default the one in
+        COMMAND_PRIORITIES.
+        """
+        if coalesce:
+            key = self._command_key(command, message)
+            for cmd in self._pending.get(key, ()):
+                if not cmd.sent and not cmd.future.done():
+                    cmd.data = self._encode_command(command, message,
+                                                    cmd.sequence)
+                    return cmd.future
+        if priority is None:
+            priority = COMMAND_PRIORITIES.get(command, PRIORITY_NORMAL)
+        return self._send_on(None, command, message, timeout, priority)
+
+    def _send_on(self, connection, command, message=None, timeout=None,
+                 priority=PRIORITY_NORMAL):
+        """Queue command for connection, or for any when None."""
+        key = self._command_key(command, message)
+        sequence = str(next(self._sequence))
+        cmd = _PendingCommand(key, sequence,
+                              self._encode_command(command, message,
+                                                   sequence),
+                              self._loop.create_future(),
+                              timeout or self._command_timeout,
+                              self._command_retries, connection)
+        self._pending.setdefault(key, collections.deque()).append(cmd)
+        self._sequences[sequence] = cmd
+        cmd.future.add_done_callback(
+            functools.partial(self._command_done, cmd))
+        # the deadline covers the time queued too
+        self._arm_deadline(cmd)
+
+        if connection is None:
+            self._outboxes[priority].append(cmd)
+        else:
+            connection.outbox.append(cmd)
+        self._send_wakeup.set()
+        return cmd.future
+
+    def _arm_command(self, cmd, connection):
+        """Count command as written on connection."""
+        if not cmd.sent:
+            cmd.sent = True
+            cmd.connection = connection
+            connection.in_flight += 1
+        cmd.replies_due += 1
+
+    def _arm_deadline(self, cmd):
+        """Fail cmd unless answered within its timeout from now."""
+        if cmd.deadline:
+            cmd.deadline.cancel()
+        cmd.deadline = self._loop.call_later(cmd.timeout,
+                                             self._command_expired, cmd)
+
+    def _command_expired(self, cmd):
+        """Deadline passed, retry commands still under process or fail."""
+        if cmd.future.done():
+            return
+        if cmd.under_process and cmd.retries > 0:
+            _LOGGER.debug('[D] Retrying %s', cmd.data)
+            cmd.retries -= 1
+            cmd.under_process = False
+            if cmd.connection.writer:
+                self._arm_command(cmd, cmd.connection)
+                self._arm_deadline(cmd)
+                cmd.connection.writer.write(cmd.data)
+                return
+        cmd.future.set_exception(
+            AioHeosException('No reply to {} within {} seconds'.format(
+                cmd.key[0], cmd.timeout)))
+
+    def _command_done(self, cmd, future):
+        """Release the window slot of a finished or cancelled command."""
+        if not future.cancelled():
+            # mark as retrieved, fire and forget callers never await it
+            future.exception()
+        if cmd.deadline:
+            cmd.deadline.cancel()
+            cmd.deadline = None
+        if cmd.sent:
+            cmd.connection.in_flight -= 1
+            self._send_wakeup.set()
+            if cmd.replies_due and cmd.connection.writer:
+                # keep absorbing the replies still to come, for a while as
+                # the device may have lost the command
+                self._loop.call_later(cmd.timeout, self._forget_command,
+                                      cmd)
+                return
+        self._forget_command(cmd)
+
+    def _forget_command(self, cmd):
+        """Stop pairing replies with cmd."""
+        cmd.replies_due = 0
+        self._sequences.pop(cmd.sequence, None)
+        queue = self._pending.get(cmd.key)
+        if queue is None:
+            return
+        try:
+            queue.remove(cmd)
+        except ValueError:
+            pass
+        if not queue:
+            del self._pending[cmd.key]
+
+    def _sent_command(self, connection, command, message):
+        """Command written on connection waiting for this reply.
+
+        The one with the sequence of the reply, or the oldest with its key
+        if the device did not echo the sequence.
+        """
+        sequence = message.get(SEQUENCE)
+        if sequence is not None:
+            cmd = self._sequences.get(sequence)
+            if (cmd is not None and cmd.key[0] == command
+                    and cmd.connection is connection and cmd.replies_due):
+                return cmd
+            return None
+        for cmd in self._pending.get(self._command_key(command, message), ()):
+            if cmd.connection is connection and cmd.replies_due:
+                return cmd
+        return None
+
+    def _resolve_command(self, connection, command, message, result=None,
+                         exc=None):
+        """Resolve the oldest written command waiting for this reply."""
+        cmd = self._sent_command(connection, command, message)
+        if cmd is None:
+            return
+        cmd.replies_due -= 1
+        if cmd.future.done():
+            _LOGGER.debug('[D] Late reply to %s', cmd.data)
+            if not cmd.replies_due:
+                self._forget_command(cmd)
+            return
+        if exc is not None:
+            cmd.future.set_exception(exc)
+        else:
+            cmd.future.set_result(result)
+
+    def _command_under_process(self, connection, command, message):
+        """Device accepted the command, give it a fresh deadline."""
+        cmd = self._sent_command(connection, command, message)
+        if cmd is not None and not cmd.future.done():
+            cmd.under_process = True
+            self._arm_deadline(cmd)
+
+    def _request_refresh(self, command, message=None):
+        """Send command triggered by an event, unless already pending.
+
+        A refresh waiting to be written, or waiting for the settle window,
+        is shared. When one is only in flight a single new one is queued, so
+        the answer reflects the state after the event.
+        """
+        key = self._command_key(command, message)
+        future = self._settling.get(key)
+        if future is not None:
+            return future
+        for cmd in self._pending.get(key, ()):
+            if not cmd.sent and not cmd.future.done():
+                return cmd.future
+        if not self._refresh_settle:
+            return self.send_command(command, message,
+                                     priority=PRIORITY_BACKGROUND)
+
+        future = self._loop.create_future()
+        future.add_done_callback(
+            lambda future: future.cancelled() or future.exception())
+        self._settling[key] = future
+
+        def settled():
+            del self._settling[key]
+            if not future.done():
+                _chain_future(
+                    self.send_command(command, message,
+                                      priority=PRIORITY_BACKGROUND), future)
+
+        self._loop.call_later(self._refresh_settle, settled)
+        return future
+
+    def _least_busy(self, limit):
+        """Command connection with the fewest commands in flight."""
+        best = None
+        for connection in self._command_connections:
+            if not connection.writer:
+                continue
+            if connection.in_flight >= limit:
+                continue
+            if best is None or connection.in_flight < best.in_flight:
+                best = connection
+        return best
+
+    def _schedule(self, priority, outbox, batches):
+        """Assign queued commands of one priority to connections."""
+        limit = self._max_in_flight
+        if priority == PRIORITY_BACKGROUND:
+            limit = self._background_slots
+        bucket = self._buckets.get(priority)
+        while outbox:
+            if outbox[0].future.done():
+                outbox.popleft()
+                continue
+            connection = self._least_busy(limit)
+            if connection is None:
+                return
+            if bucket is not None:
+                delay = bucket.delay(self._loop.time())
+                if delay:
+                    self._wakeup_later(delay)
+                    return
+                bucket.take()
+            cmd = outbox.popleft()
+            self._arm_command(cmd, connection)
+            batches.setdefault(connection, []).append(cmd.data)
+
+    def _schedule_pinned(self, connection, batches):
+        """Assign commands queued for connection to it.
+
+        Heart beats do not wait for room in the window, a full window is
+        what they are to find out about.
+        """
+        blocked = collections.deque()
+        outbox = connection.outbox
+        while outbox:
+            cmd = outbox.popleft()
+            if cmd.future.done():
+                continue
+            if (connection.in_flight >= self._max_in_flight
+                    and cmd.key[0] != SYSTEM_HEART_BEAT):
+                blocked.append(cmd)
+                continue
+            self._arm_command(cmd, connection)
+            batches.setdefault(connection, []).append(cmd.data)
+        connection.outbox = blocked
+
+    def _wakeup_later(self, delay):
+        """Wake up the sender once a rate limit allows sending again."""
+        if self._send_timer is not None:
+            return
+
+        def wakeup():
+            self._send_timer = None
+            self._send_wakeup.set()
+
+        self._send_timer = self._loop.call_later(delay, wakeup)
+
+    async def _async_send(self):
+        """Write queued commands while the in-flight windows have room."""
+        while not self._close_requested:
+            try:
+                await self._send_wakeup.wait()
+                self._send_wakeup.clear()
+                # everything queued this loop iteration goes in one write
+                # per connection, session setup and heart beats first
+                batches = {}
+                for connection in self._connections:
+                    if connection.writer:
+                        self._schedule_pinned(connection, batches)
+                for priority, outbox in enumerate(self._outboxes):
+                    self._schedule(priority, outbox, batches)
+                for connection, batch in batches.items():
+                    if _LOGGER.isEnabledFor(logging.DEBUG):
+                        _LOGGER.debug('[D] Sending on %s %s', connection.name,
+                                      batch)
+                    connection.writer.write(b''.join(batch))
+                for connection in batches:
+                    await connection.writer.drain()
+            except (GeneratorExit, CancelledError):
+                return
+            except Exception:    # pylint: disable=broad-except
+                _LOGGER.debug('[E] Ignoring', exc_info=True)
 
     @staticmethod
     def _parse_message(message):
         """Parse message."""
-        result = {}
-        if message:
-            for elem in message.split('&'):
-                parts = elem.split('=')
-                if len(parts) == 2:
-                    result[parts[0]] = parts[1]
-                elif len(parts) == 1:
-                    result[parts[0]] = True
-                else:
-                    _LOGGER.warning('[W] No parts found in %s', message)
-
-        return result
+        return aioheosmessage.parse_message(message)
 
     def _handle_error(self, message):
         eid = message['eid']
         if eid == '2':
             pid = message['pid']
             player = self.get_player(pid)
-            player.play_state = None
+            if player:
+                player.play_state = None
             raise AioHeosException('Player {} is offline'.format(pid))
         else:
             raise AioHeosException(message)
 
+    def register_handler(self, command, handler):
+        """Register handler(payload, message) for an unhandled command."""
+        if command in self._handlers:
+            raise AioHeosException(
+                'Command {} is already handled'.format(command))
+        self._handlers[command] = handler
+
     def _dispatcher(self, command, message, payload):
         """Call parser functions."""
-        _LOGGER.debug('DISPATCHER')
-        _LOGGER.debug('[D] %s %s %s', command, message, payload)
-        callbacks = {
-            GET_PLAYERS:
-            self._parse_players,
-            GET_GROUPS:
-            self._parse_groups,
-            SET_GROUP:
-            self._parse_set_group,
-            GET_PLAY_STATE:
-            self._parse_play_state,
-            SET_PLAY_STATE:
-            self._parse_play_state,
-            GET_MUTE_STATE:
-            self._parse_mute_state,
-            SET_MUTE_STATE:
-            self._parse_mute_state,
-            GET_VOLUME:
-            self._parse_volume,
-            SET_VOLUME:
-            self._parse_volume,
-            GET_NOW_PLAYING_MEDIA:
-            self._parse_now_playing_media,
-            EVENT_PLAYER_VOLUME_CHANGED:
-            self._parse_player_volume_changed,
-            EVENT_GROUP_VOLUME_CHANGED:
-            self._parse_group_volume_changed,
-            EVENT_PLAYER_STATE_CHANGED:
-            self._parse_player_state_changed,
-            EVENT_PLAYERS_CHANGED:
-            self._parse_players_changed,
-            EVENT_PLAYER_NOW_PLAYING_CHANGED:
-            self._parse_player_now_playing_changed,
-            EVENT_PLAYER_NOW_PLAYING_PROGRESS:
-            self._parse_player_now_playing_progress,
-            EVENT_GROUPS_CHANGED:
-            self._parse_groups_changed,
-            SYSTEM_SIGNIN:
-            self._parse_system_signin,
-            BROWSE_MUSIC_SOURCES:
-            self._parse_browse_music_source,
-            BROWSE_BROWSE:
-            self._parse_browse_browse,
-        }
-        commands_ignored = (SYSTEM_PRETTIFY, SYSTEM_REGISTER_FOR_EVENTS,
-                            EVENT_PLAYER_QUEUE_CHANGED, EVENT_SOURCES_CHANGED,
-                            EVENT_USER_CHANGED, EVENT_SHUTTLE_MODE_CHANGED,
-                            EVENT_REPEAT_MODE_CHANGED)
-        if command in callbacks:
-            callbacks[command](payload, message)
-        elif command in commands_ignored:
-            _LOGGER.debug('[D] command "%s" is ignored.', command)
-        else:
-            _LOGGER.debug('[D] command "%s" is not handled.', command)
+        handler = self._handlers.get(command)
+        if handler:
+            handler(payload, message)
+        elif _LOGGER.isEnabledFor(logging.DEBUG):
+            if command in COMMANDS_IGNORED:
+                _LOGGER.debug('[D] command "%s" is ignored.', command)
+            else:
+                _LOGGER.debug('[D] command "%s" is not handled.', command)
 
-    def _parse_command(self, data):
+    def _parse_command(self, record, connection=None):
         " parse command "
+        command = record.command
+        message = record.message
+        connection = connection or self._event_connection
         try:
-            data_heos = data['heos']
-            command = data_heos['command']
-            message = {}
-            if 'message' in data_heos:
-                if data_heos['message'].startswith('command under process'):
-                    return None
-                message = self._parse_message(data_heos['message'])
-            if 'result' in data_heos.keys() and data_heos['result'] == 'fail':
-                self._handle_error(message)
-            if 'payload' in data.keys():
-                self._dispatcher(command, message, data['payload'])
-            elif 'message' in data_heos.keys():
-                self._dispatcher(command, message, None)
-            elif 'command' in data_heos.keys():
-                self._dispatcher(command, None, None)
-            else:
-                raise AioHeosException(
-                    'No message or payload in reply. payload {}'.format(data))
+            if record.under_process:
+                self._command_under_process(connection, command, message)
+                return None
+            if record.failed:
+                try:
+                    self._handle_error(message)
+                except AioHeosException as exc:
+                    exc.record = record
+                    self._resolve_command(connection, command, message,
+                                          exc=exc)
+                    raise
+            self._dispatcher(command, message, record.payload)
+            if not record.is_event:
+                self._resolve_command(connection, command, message,
+                                      result=record)
         # pylint: disable=bare-except
         except AioHeosException as exc:
             raise exc
         except Exception:
-            _LOGGER.exception("Unexpected error for msg '%s'", data)
-            raise AioHeosException('Problem parsing command.')
+            _LOGGER.exception("Unexpected error for msg '%s'", record)
+            exc = AioHeosException('Problem parsing command.')
+            self._resolve_command(connection, command, message, exc=exc)
+            raise exc
 
         return None
 
-    async def _callback_wrapper(self, callback):
+    async def _callback_wrapper(self, callback, *args):
         if callback:
             try:
-                await callback()
+                await callback(*args)
             except Exception:    # pylint: disable=broad-except
                 pass
 
-    async def _async_subscribe(self, callback=None):
+    def _mark_changed(self, player):
+        """Player or group changed, schedule coalesced callback."""
+        if self._coalesce is None or not self._callback:
+            return
+        self._changed.add(player)
+        if self._flush_handle is None:
+            if self._coalesce:
+                self._flush_handle = self._loop.call_later(
+                    self._coalesce, self._flush_changed)
+            else:
+                self._flush_handle = self._loop.call_soon(self._flush_changed)
+
+    def _flush_changed(self):
+        """Call callback once with everything changed in the window."""
+        self._flush_handle = None
+        changed, self._changed = self._changed, set()
+        self._loop.create_task(self._callback_wrapper(self._callback, changed))
+
+    async def _async_subscribe(self, connection, callback=None):
         """ event loop """
         # pylint: disable=too-many-branches,logging-too-many-args
+        # readline does not yield while lines are buffered, with several
+        # connections give the others a turn during a burst of events
+        share = len(self._connections) > 1
+        received = 0
         while not self._close_requested:
+            if share:
+                received += 1
+                if received % READ_SLICE == 0:
+                    await asyncio.sleep(0)
             try:
-                msg = await self._reader.readline()
+                msg = await connection.reader.readline()
             except TimeoutError:
                 _LOGGER.warning(
                     '[W] Connection got timed out, try to reconnect...',
                     exc_info=True)
-                await self._connect()
+                await self._reconnect(connection)
                 continue
-            except ConnectionResetError:
+            except OSError:
                 _LOGGER.warning(
                     '[W] Peer reset our connection, try to reconnect...',
                     exc_info=True)
-                await self._connect()
+                await self._reconnect(connection)
                 continue
             except (GeneratorExit, CancelledError):
                 _LOGGER.debug('[I] Cancelling event loop...', exc_info=True)
@@ -369,23 +1125,51 @@ class AioHeosController:
             except Exception:    # pylint: disable=broad-except
                 _LOGGER.debug('[E] Ignoring', exc_info=True)
                 continue
-            _LOGGER.debug(msg.decode())
-            # simplejson doesnt need to decode from byte to ascii
-            data = json.loads(msg.decode())
-            _LOGGER.debug('DATA:')
-            _LOGGER.debug(data)
+            if not msg:
+                if self._close_requested:
+                    return
+                _LOGGER.warning(
+                    '[W] Peer closed our connection, try to reconnect...')
+                await self._reconnect(connection)
+                continue
+            try:
+                record = aioheosmessage.parse_line(msg)
+            except ValueError:
+                _LOGGER.error('[E] Unable to parse %s', msg)
+                continue
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug('[D] DATA: %r', record)
             try:
-                self._parse_command(data)
+                self._parse_command(record, connection)
             except AioHeosException as exc:
-                _LOGGER.error('[E]', exc)
-                _LOGGER.debug('MSG', msg)
-                _LOGGER.debug('MSG decoded', msg.decode())
-                _LOGGER.debug('MSG json', data)
+                _LOGGER.error('[E] %s', exc.message)
+                _LOGGER.debug('[D] MSG %s', msg)
                 continue
+            if self._event_streams and record.is_event:
+                await self._publish(record)
             if callback:
-                _LOGGER.debug('TRIGGER CALLBACK')
                 self._loop.create_task(self._callback_wrapper(callback))
 
+    # pylint: disable=redefined-builtin
+    def events(self, filter=None, maxsize=100,
+               policy=aioheosevents.DROP_OLDEST):
+        """Return a stream of events, use as 'async for event in stream'.
+
+        filter is a collection of commands, e.g. EVENT_PLAYER_STATE_CHANGED,
+        or a callable taking the HeosMessage. See AioHeosEventStream for the
+        overflow policies.
+        """
+        stream = aioheosevents.AioHeosEventStream(
+            self._loop, filter, maxsize, policy, self._event_streams.remove)
+        self._event_streams.append(stream)
+        return stream
+
+    async def _publish(self, record):
+        """Queue event on every stream accepting it."""
+        for stream in list(self._event_streams):
+            if stream.accepts(record):
+                await stream.put(record)
+
     def new_device_callback(self, callback):
         """Callback when new device."""
         self._new_device_callback = callback
@@ -394,33 +1178,64 @@ class AioHeosController:
         " close "
         _LOGGER.info('[I] Closing down...')
         self._close_requested = True
-        if self._writer:
-            self._writer.close()
-        if self._subscribtion_task:
-            self._subscribtion_task.cancel()
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for stream in list(self._event_streams):
+            stream.close()
+        for future in self._settling.values():
+            future.cancel()
+        for queue in list(self._pending.values()):
+            for cmd in list(queue):
+                cmd.future.cancel()
+        for outbox in self._outboxes:
+            outbox.clear()
+        if self._send_timer:
+            self._send_timer.cancel()
+        for connection in self._connections:
+            connection.outbox.clear()
+            if connection.writer:
+                connection.writer.close()
+        if self._resync_task:
+            self._resync_task.cancel()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        if self._upnp:
+            await self._upnp.close()
+        if self._ssdp_listener:
+            self._ssdp_listener.close()
+        if self._send_task:
+            self._send_task.cancel()
             try:
-                await self._subscribtion_task
+                await self._send_task
             except asyncio.CancelledError:
                 pass
+        for connection in self._connections:
+            if connection.task:
+                connection.task.cancel()
+                try:
+                    await connection.task
+                except asyncio.CancelledError:
+                    pass
 
     def register_for_change_events(self):
         " register for change events "
-        self.send_command(SYSTEM_REGISTER_FOR_EVENTS, {'enable': 'on'})
+        return self.send_command(SYSTEM_REGISTER_FOR_EVENTS, {'enable': 'on'})
 
     def register_pretty_json(self, enable=False):
         " register for pretty json "
         set_enable = 'off'
         if enable:
             set_enable = 'on'
-        self.send_command(SYSTEM_PRETTIFY, {'enable': set_enable})
+        return self.send_command(SYSTEM_PRETTIFY, {'enable': set_enable})
 
     def request_players(self):
         " get players "
-        self.send_command(GET_PLAYERS)
+        return self.send_command(GET_PLAYERS)
 
     def login(self):
         " login "
-        self.send_command(SYSTEM_SIGNIN, {
+        return self.send_command(SYSTEM_SIGNIN, {
             'un': self._username,
             'pw': self._password
         })
@@ -431,10 +1246,12 @@ class AioHeosController:
             self._players = []
 
         for player in _players_json:
-            old_player = self.get_player(player['pid'])
+            pid = str(player['pid'])
+            old_player = self._player_index.get(pid)
             if not old_player:
                 new_player = aioheosplayer.AioHeosPlayer(self, player)
                 self._players.append(new_player)
+                self._player_index[pid] = new_player
                 if self._new_device_callback:
                     self._new_device_callback(new_player)
             else:
@@ -446,24 +1263,32 @@ class AioHeosController:
         if not self._groups:
             self._groups = []
 
-        group_copy = self._groups
+        removed = dict(self._group_index)
+        self._player_group_index = {}
         for group in _groups_json:
-            old_group = self.get_group(group['gid'])
+            gid = str(group['gid'])
+            old_group = self._group_index.get(gid)
             if not old_group:
                 new_group = aioheosgroup.AioHeosGroup(self, group)
                 self._groups.append(new_group)
+                self._group_index[gid] = new_group
                 if self._new_device_callback:
                     self._new_device_callback(new_group)
             else:
                 old_group.player_info = group
-                group_copy.remove(group)
+                removed.pop(gid, None)
+            for member in group.get('players', ()):
+                self._player_group_index[str(member['pid'])] = \
+                    self._group_index[gid]
 
-        for remove_group in group_copy:
-            # Make group offline
+        for gid, remove_group in removed.items():
+            # Make group offline, and forget it
             remove_group.play_state = None
+            del self._group_index[gid]
+            self._groups.remove(remove_group)
 
     def _parse_set_group(self, _payload, _message):
-        self.request_groups()
+        self._request_refresh(GET_GROUPS)
 
     def _parse_system_signin(self, _payload, _message):
         self._need_login = False
@@ -477,101 +1302,134 @@ class AioHeosController:
         return self._groups
 
     def get_player(self, pid):
-        """ get player from array """
-        for player in self._players:
-            if player.player_id == pid:
-                return player
-        return None
+        """ get player by pid """
+        return self._player_index.get(str(pid))
 
     def get_group(self, pid):
-        """Get group from array."""
-        for group in self._groups:
-            if group.player_id == pid:
-                return group
-        return None
+        """Get group by gid."""
+        return self._group_index.get(str(pid))
+
+    def get_player_group(self, pid):
+        """Get the group a player is a member of."""
+        return self._player_group_index.get(str(pid))
+
+    def _queue_refresh(self, pids, fields=None,
+                       priority=PRIORITY_BACKGROUND):
+        """Queue refresh commands, return list of (pid, future)."""
+        try:
+            commands = [REFRESH_FIELDS[field]
+                        for field in fields or REFRESH_FIELDS]
+        except KeyError as exc:
+            raise AioHeosException('Unknown field {}'.format(exc))
+
+        return [(str(pid),
+                 self.send_command(command, {'pid': pid}, priority=priority))
+                for pid in pids for command in commands]
+
+    async def refresh(self, pids, fields=None, priority=PRIORITY_BACKGROUND):
+        """Refresh state of players, return once every reply is in.
+
+        fields is a collection of REFRESH_FIELDS keys, all by default.
+        Returns a dict of pid to AioHeosException for players which failed,
+        e.g. because they are offline; other players are still refreshed.
+        """
+        requests = self._queue_refresh(pids, fields, priority)
+        results = await asyncio.gather(*[future for _, future in requests],
+                                       return_exceptions=True)
+        failures = {}
+        for (pid, _), result in zip(requests, results):
+            if isinstance(result, Exception):
+                failures.setdefault(pid, result)
+        return failures
+
+    async def refresh_all(self, fields=None, priority=PRIORITY_BACKGROUND):
+        """Refresh state of all players, see refresh."""
+        return await self.refresh(list(self._player_index), fields, priority)
 
     def request_player_info(self, pid):
         " request player info "
-        self.send_command(GET_PLAYER_INFO, {'pid': pid})
+        return self.send_command(GET_PLAYER_INFO, {'pid': pid})
 
     def request_play_state(self, pid):
         " request play state "
-        self.send_command(GET_PLAY_STATE, {'pid': pid})
+        return self.send_command(GET_PLAY_STATE, {'pid': pid})
 
     def _parse_play_state(self, _payload, message):
         self.get_player(message['pid']).play_state = message['state']
-        if self.get_group(message['pid']):
-            self.get_group(message['pid']).play_state = message['state']
+        group = self.get_group(message['pid'])
+        if group:
+            group.play_state = message['state']
 
     def request_mute_state(self, pid):
         " request mute state "
-        self.send_command(GET_MUTE_STATE, {'pid': pid})
+        return self.send_command(GET_MUTE_STATE, {'pid': pid})
 
     def _parse_mute_state(self, _payload, message):
         self.get_player(message['pid']).mute = message['state']
-        if self.get_group(message['pid']):
-            self.get_group(message['pid']).mute = message['state']
+        group = self.get_group(message['pid'])
+        if group:
+            group.mute = message['state']
 
     def request_volume(self, pid):
         " request volume "
-        self.send_command(GET_VOLUME, {'pid': pid})
+        return self.send_command(GET_VOLUME, {'pid': pid})
 
     def set_volume(self, volume_level, pid):
         " set volume "
         volume = min(100, max(0, volume_level))
-        self.send_command(SET_VOLUME, {'pid': pid, 'level': volume})
+        return self.send_command(SET_VOLUME, {'pid': pid, 'level': volume},
+                                 coalesce=True)
 
     def _parse_volume(self, _payload, message):
         self.get_player(message['pid']).volume = float(message['level'])
-        if self.get_group(message['pid']):
-            self.get_group(message['pid']).volume = float(message['level'])
+        group = self.get_group(message['pid'])
+        if group:
+            group.volume = float(message['level'])
 
     def _set_play_state(self, state, pid):
         " set play state "
         if state not in ('play', 'pause', 'stop'):
             AioHeosException('Not an accepted play state {}.'.format(state))
 
-        self.send_command(SET_PLAY_STATE, {
+        return self.send_command(SET_PLAY_STATE, {
             'pid': pid,
             'state': state
-        })
+        }, coalesce=True)
 
     def stop(self, pid=None):
         " stop player "
-        self._set_play_state('stop', pid)
+        return self._set_play_state('stop', pid)
 
     def play(self, pid=None):
         " play "
-        self._set_play_state('play', pid)
+        return self._set_play_state('play', pid)
 
     def pause(self, pid=None):
         " pause "
-        self._set_play_state('pause', pid)
+        return self._set_play_state('pause', pid)
 
     def request_now_playing_media(self, pid):
         " get playing media "
-        self.send_command(GET_NOW_PLAYING_MEDIA,
-                          {'pid': pid})
+        return self.send_command(GET_NOW_PLAYING_MEDIA, {'pid': pid})
 
     def _parse_now_playing_media(self, payload, message):
         player = self.get_player(message["pid"])
-        player.reset_now_playing()
-
-        player.media_artist = payload.get('artist')
-        player.media_album = payload.get('album')
-        player.media_title = payload.get('song')
-        player.media_image_url = payload.get('image_url')
-        player.media_id = payload.get('mid')
-
-        if 'sid' in payload:
-            player.sid = payload['sid']
-            if self._music_sources:
-                source_obj = self._music_sources.get(player.sid,
-                                                     {'name': 'unknown'})
-                _LOGGER.debug("[D] SOURCE %s", source_obj)
-                player.source_name = source_obj['name']
-
-        player.qid = payload.get('qid')
+        with player.batch_update():
+            player.media_artist = payload.get('artist')
+            player.media_album = payload.get('album')
+            player.media_title = payload.get('song')
+            player.media_image_url = payload.get('image_url')
+            player.media_id = payload.get('mid')
+
+            if 'sid' in payload:
+                player.sid = payload['sid']
+                if self._music_sources:
+                    source_obj = self._music_sources.get(player.sid,
+                                                         {'name': 'unknown'})
+                    _LOGGER.debug("[D] SOURCE %s", source_obj)
+                    player.source_name = source_obj['name']
+
+            player.qid = payload.get('qid')
 
         _LOGGER.debug("[D] _parse_now_playing_media %s", vars(player))
 
@@ -581,15 +1439,15 @@ class AioHeosController:
 
     def request_queue(self, pid):
         " request queue "
-        self.send_command(GET_QUEUE, {'pid': pid})
+        return self.send_command(GET_QUEUE, {'pid': pid})
 
     def clear_queue(self, pid):
         " clear queue "
-        self.send_command(CLEAR_QUEUE, {'pid': pid})
+        return self.send_command(CLEAR_QUEUE, {'pid': pid})
 
     def request_play_next(self, pid):
         " play next "
-        self.send_command(PLAY_NEXT, {'pid': pid})
+        return self.send_command(PLAY_NEXT, {'pid': pid})
 
     def _parse_play_next(self, payload, message):
         " parse play next "
@@ -597,15 +1455,15 @@ class AioHeosController:
 
     def request_play_previous(self, pid):
         " play prev "
-        self.send_command(PLAY_PREVIOUS, {'pid': pid})
+        return self.send_command(PLAY_PREVIOUS, {'pid': pid})
 
     def play_queue(self, pid, qid):
         " play queue "
-        self.send_command(PLAY_QUEUE, {'pid': pid, 'qid': qid})
+        return self.send_command(PLAY_QUEUE, {'pid': pid, 'qid': qid})
 
     def play_stream(self, pid, sid, mid):
         " play_stream "
-        self.send_command(BROWSE_PLAY_STREAM, {
+        return self.send_command(BROWSE_PLAY_STREAM, {
             'pid': pid,
             'mid': mid,
             'sid': sid
@@ -613,7 +1471,7 @@ class AioHeosController:
 
     def play_favourite(self, pid, mid):
         " play play_favourite "
-        self.send_command(BROWSE_PLAY_STREAM, {
+        return self.send_command(BROWSE_PLAY_STREAM, {
             'pid': pid,
             'mid': mid,
             'sid': self._favourites_sid
@@ -621,49 +1479,63 @@ class AioHeosController:
 
     def request_groups(self):
         " get groups "
-        self.send_command(GET_GROUPS)
+        return self.send_command(GET_GROUPS)
 
     def set_group(self, leader_pid, member_pids):
         " set group "
         members = str(leader_pid)
         for member in member_pids:
             members = members + "," + str(member)
-        self.send_command(SET_GROUP, {'pid': members})
+        return self.send_command(SET_GROUP, {'pid': members})
 
     def toggle_mute(self, pid):
         " toggle mute "
-        self.send_command(TOGGLE_MUTE, {'pid': pid})
+        return self.send_command(TOGGLE_MUTE, {'pid': pid})
 
     def set_mute(self, pid, mute):
         " set mute "
-        self.send_command(SET_MUTE_STATE, {
+        return self.send_command(SET_MUTE_STATE, {
             'pid': pid,
             'state': 'on' if mute else 'off'
-        })
+        }, coalesce=True)
 
     def request_music_sources(self):
         " get music sources "
-        self.send_command(BROWSE_MUSIC_SOURCES, {'range': '0,29'})
+        return self.send_command(BROWSE_MUSIC_SOURCES, {'range': '0,29'})
 
     def request_browse_source(self, sid):
         " browse source "
-        self.send_command(BROWSE, {'sid': sid, 'range': '0,29'})
+        return self.send_command(BROWSE, {'sid': sid, 'range': '0,29'})
+
+    def _get_upnp(self):
+        if not self._upnp:
+            # content is played on the device connected to
+            self._upnp = aioheosupnp.AioHeosUpnp(
+                loop=self._loop,
+                cache=self._discovery_cache,
+                descriptions=self._description_cache,
+                host=self._host)
+        return self._upnp
 
     def play_content(self, content, content_type='audio/mpeg'):
-        """ play content """
-        self._loop.create_task(self._upnp.play_content(content, content_type))
+        """ play content, bytes, a file path or an async iterator of bytes,
+        see aioheosupnp.PlayContentServer """
+        self._loop.create_task(self._get_upnp().play_content(
+            content, content_type))
         # asyncio.wait([task])
 
     def _parse_player_volume_changed(self, _payload, message):
         player = self.get_player(message["pid"])
-        player.mute = message['mute']
-        player.volume = float(message['level'])
+        with player.batch_update():
+            player.mute = message['mute']
+            player.volume = float(message['level'])
 
     def _parse_group_volume_changed(self, _payload, message):
         group = self.get_group(message["gid"])
         if group:
-            group.mute = message['mute']
-            group.volume = float(message['level'])
+            with group.batch_update():
+                group.mute = message['mute']
+                group.volume = float(message['level'])
 
     def _parse_player_state_changed(self, _payload, message):
         player = self.get_player(message["pid"])
@@ -673,20 +1545,26 @@ class AioHeosController:
             group.play_state = message['state']
 
     def _parse_groups_changed(self, _payload, _message):
-        self.request_groups()
+        self._request_refresh(GET_GROUPS)
 
     def _parse_players_changed(self, _payload, _message):
-        self.request_players()
+        self._request_refresh(GET_PLAYERS)
 
     def _parse_player_now_playing_changed(self, _payload, _message):
         " event / now playing changed, request what changed. "
         player_id = _message['pid']
-        self.request_now_playing_media(player_id)
+        self._request_refresh(GET_NOW_PLAYING_MEDIA, {'pid': player_id})
 
     def _parse_player_now_playing_progress(self, _payload, message):
         player = self.get_player(message["pid"])
-        player.current_position = int(message['cur_pos'])
-        player.duration = int(message['duration'])
+        if self._progress_resync is not None:
+            player.sync_position(int(message['cur_pos']),
+                                 int(message['duration']),
+                                 self._progress_resync)
+            return
+        with player.batch_update():
+            player.current_position = int(message['cur_pos'])
+            player.duration = int(message['duration'])
 
     def _parse_browse_music_source(self, payload, _message):
         _LOGGER.debug("[D] _parse_browse_music_source %s", payload)
@@ -708,6 +1586,8 @@ class AioHeosController:
         if str(message['sid']) == str(self._favourites_sid):
             _LOGGER.debug("[D] Favorites: %s", payload)
             self._favourites = payload
+            if not self._favourites_loaded.done():
+                self._favourites_loaded.set_result(payload)
 
     def get_music_sources(self):
         """Get music source."""
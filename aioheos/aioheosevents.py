@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Heos event stream."""
+
+import collections
+import itertools
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# overflow policies
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+BLOCK = 'block'
+
+
+class AioHeosEventStream:
+    """Bounded stream of events for one consumer.
+
+    Iterate with 'async for event in stream', every event is a HeosMessage.
+    When the buffer is full the policy decides what happens: DROP_OLDEST
+    discards the oldest event, COALESCE replaces a buffered event with the
+    same (pid, command) and otherwise drops the oldest, BLOCK makes the
+    controller stop reading until the consumer catches up.
+    """
+
+    # pylint: disable=redefined-builtin
+    def __init__(self, loop, filter=None, maxsize=100, policy=DROP_OLDEST,
+                 on_close=None):
+        if policy not in (DROP_OLDEST, COALESCE, BLOCK):
+            raise ValueError('Unknown overflow policy {}'.format(policy))
+        if filter is None or callable(filter):
+            self._filter = filter
+        else:
+            commands = frozenset(filter)
+            self._filter = lambda event: event.command in commands
+        self._loop = loop
+        self._on_close = on_close
+        self._maxsize = maxsize
+        self._policy = policy
+        self._queue = collections.OrderedDict()
+        self._seq = itertools.count()
+        self._getter = None
+        self._putters = collections.deque()
+        self._closed = False
+        self.dropped = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self._closed:
+                raise StopAsyncIteration
+            self._getter = self._loop.create_future()
+            try:
+                await self._getter
+            finally:
+                self._getter = None
+        _, event = self._queue.popitem(last=False)
+        self._wakeup_putter()
+        return event
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def accepts(self, event):
+        """Return True if event passes the filter."""
+        return self._filter is None or self._filter(event)
+
+    async def put(self, event):
+        """Queue event, waits for room with the BLOCK policy."""
+        if self._closed:
+            return
+        if self._policy == COALESCE:
+            key = (event.message.get('pid'), event.command)
+            if key in self._queue:
+                self._queue[key] = event
+                return
+        else:
+            key = next(self._seq)
+
+        while len(self._queue) >= self._maxsize:
+            if self._policy != BLOCK:
+                self._queue.popitem(last=False)
+                self.dropped += 1
+                continue
+            putter = self._loop.create_future()
+            self._putters.append(putter)
+            await putter
+            if self._closed:
+                return
+
+        self._queue[key] = event
+        if self._getter and not self._getter.done():
+            self._getter.set_result(None)
+
+    def _wakeup_putter(self):
+        while self._putters:
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+    def close(self):
+        """Stop the stream, buffered events are still delivered."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._on_close:
+            self._on_close(self)
+        if self._getter and not self._getter.done():
+            self._getter.set_result(None)
+        while self._putters:
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
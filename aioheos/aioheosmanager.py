@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Heos python lib, several Heos systems in one process."""
+
+import asyncio
+import functools
+import logging
+
+from . import aioheoscontroller
+from . import aioheosupnp
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AioHeosManager:
+    """Several Heos systems managed from one process.
+
+    Every host gets an AioHeosController of its own, the keyword options
+    are passed on to all of them. Players and groups of all systems share
+    one index, and commands are routed by pid to the controller the player
+    or group belongs to.
+    """
+
+    def __init__(self, loop, hosts=(), **options):
+        self._loop = loop
+        self._discovery_cache = options.get('discovery_cache')
+        self._options = options
+        self._controllers = {}
+        self._connecting = {}
+        self._routes = {}
+        self._upnp = None
+        self._callback = None
+        self._coalesce = None
+        self._started = False
+        for host in hosts:
+            self.add_host(host)
+
+    @property
+    def controllers(self):
+        """Controllers by host."""
+        return dict(self._controllers)
+
+    def get_controller(self, host):
+        """Get controller by host."""
+        return self._controllers.get(host)
+
+    def add_host(self, host, **options):
+        """Add a system, connected right away once the manager is.
+
+        options override the ones given to the manager for this host.
+        """
+        controller = self._controllers.get(host)
+        if controller is not None:
+            return controller
+        controller = aioheoscontroller.AioHeosController(
+            self._loop, host=host, **dict(self._options, **options))
+        self._controllers[host] = controller
+        if self._started:
+            self._start(host, controller)
+        return controller
+
+    async def remove_host(self, host):
+        """Disconnect and forget a system."""
+        controller = self._controllers.pop(host, None)
+        task = self._connecting.pop(host, None)
+        if task:
+            task.cancel()
+        if controller is None:
+            return
+        self._routes = {
+            pid: owner
+            for pid, owner in self._routes.items() if owner is not controller
+        }
+        await controller.close()
+
+    async def discover(self, timeout=None):
+        """Add the systems found by discovery.
+
+        Once connected, devices found which are players of a known system
+        are skipped, so every system is added once. timeout limits the
+        wait for each connection.
+        """
+        if not self._upnp:
+            self._upnp = aioheosupnp.AioHeosUpnp(
+                loop=self._loop, cache=self._discovery_cache,
+                descriptions=self._options.get('description_cache'))
+        for device in await self._upnp.discover_all():
+            host = device.host
+            if host in self._controllers or any(
+                    player.ip_address == host
+                    for player in self.get_players()):
+                continue
+            self.add_host(host)
+            task = self._connecting.get(host)
+            if task:
+                await asyncio.wait([task], timeout=timeout)
+
+    def _start(self, host, controller):
+        """Connect controller in the background."""
+        task = self._loop.create_task(
+            controller.connect(self._callback, self._coalesce))
+        self._connecting[host] = task
+        task.add_done_callback(functools.partial(self._connected, host))
+        return task
+
+    def _connected(self, host, task):
+        if self._connecting.get(host) is task:
+            del self._connecting[host]
+        if not task.cancelled() and task.exception() is not None:
+            _LOGGER.error('[E] Connecting to %s failed: %s', host,
+                          task.exception())
+
+    async def connect(self, callback=None, coalesce=None, timeout=None):
+        """Connect to every system, discover them if none were added.
+
+        Systems are connected in parallel, callback and coalesce are as for
+        AioHeosController.connect. With timeout set, return after timeout
+        seconds even if some systems are not reachable yet, those keep
+        trying in the background.
+        """
+        self._callback = callback
+        self._coalesce = coalesce
+        added = list(self._controllers.items())
+        self._started = True
+        if not added:
+            # connected while discovered
+            await self.discover(timeout)
+        for host, controller in added:
+            self._start(host, controller)
+        if self._connecting:
+            await asyncio.wait(list(self._connecting.values()),
+                               timeout=timeout)
+
+    async def close(self):
+        " close "
+        self._started = False
+        for task in self._connecting.values():
+            task.cancel()
+        self._connecting.clear()
+        self._routes.clear()
+        if self._upnp:
+            await self._upnp.close()
+        await asyncio.gather(
+            *(controller.close() for controller in self._controllers.values()))
+
+    def controller_for(self, pid):
+        """Controller of the system a player or group belongs to."""
+        pid = str(pid)
+        controller = self._routes.get(pid)
+        if controller is not None and self._owns(controller, pid):
+            return controller
+        self._routes.pop(pid, None)
+        for controller in self._controllers.values():
+            if self._owns(controller, pid):
+                self._routes[pid] = controller
+                return controller
+        return None
+
+    @staticmethod
+    def _owns(controller, pid):
+        return (controller.get_player(pid) is not None
+                or controller.get_group(pid) is not None)
+
+    def get_players(self):
+        """Players of all systems."""
+        return [
+            player for controller in self._controllers.values()
+            for player in controller.get_players() or ()
+        ]
+
+    def get_groups(self):
+        """Groups of all systems."""
+        return [
+            group for controller in self._controllers.values()
+            for group in controller.get_groups() or ()
+        ]
+
+    def get_player(self, pid):
+        """Get player by pid."""
+        controller = self.controller_for(pid)
+        return controller.get_player(pid) if controller else None
+
+    def get_group(self, pid):
+        """Get group by gid."""
+        controller = self.controller_for(pid)
+        return controller.get_group(pid) if controller else None
+
+    def get_player_group(self, pid):
+        """Get the group a player is a member of."""
+        controller = self.controller_for(pid)
+        return controller.get_player_group(pid) if controller else None
+
+    def send_command(self, command, message, **kwargs):
+        """Send command to the system of the pid or gid in message.
+
+        See AioHeosController.send_command.
+        """
+        pid = message.get('pid', message.get('gid'))
+        controller = self.controller_for(pid) if pid is not None else None
+        if controller is None:
+            raise aioheoscontroller.AioHeosException(
+                'No system with player {}'.format(pid))
+        return controller.send_command(command, message, **kwargs)
+
+    async def refresh_all(self, fields=None):
+        """Refresh state of all players of all systems.
+
+        Returns a dict of pid to AioHeosException for players which failed.
+        """
+        failures = {}
+        for result in await asyncio.gather(
+                *(controller.refresh_all(fields)
+                  for controller in self._controllers.values())):
+            failures.update(result)
+        return failures
+
+    def stats(self):
+        """Connection statistics by host."""
+        return {
+            host: controller.stats()
+            for host, controller in self._controllers.items()
+        }
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Heos message parser."""
+
+import json
+import re
+from urllib.parse import unquote
+
+try:
+    import orjson
+except ImportError:
+    orjson = None    # pylint: disable=invalid-name
+
+# pylint: disable=invalid-name
+_loads = orjson.loads if orjson else json.loads
+# pylint: enable=invalid-name
+
+UNDER_PROCESS = 'command under process'
+
+# payload free envelope, as sent for events and most replies, only used
+# when orjson is missing as orjson beats both the regex and json module
+_ENVELOPE = re.compile(
+    rb'\s*\{\s*"heos"\s*:\s*\{\s*"command"\s*:\s*"([^"\\]*)"\s*'
+    rb'(?:,\s*"result"\s*:\s*"([^"\\]*)"\s*)?'
+    rb'(?:,\s*"message"\s*:\s*"([^"\\]*)"\s*)?\}\s*\}\s*$')
+
+
+class HeosMessage:
+    """Reply or event received from a Heos device."""
+
+    __slots__ = ('command', 'result', 'raw_message', 'message', 'payload',
+                 'line')
+
+    def __init__(self, command, result=None, raw_message='', payload=None,
+                 line=None):
+        self.command = command
+        self.result = result
+        self.raw_message = raw_message
+        self.message = parse_message(raw_message)
+        self.payload = payload
+        # line as received
+        self.line = line
+
+    def __repr__(self):
+        return 'HeosMessage({!r}, {!r}, {!r}, {!r})'.format(
+            self.command, self.result, self.raw_message, self.payload)
+
+    @property
+    def is_event(self):
+        """Unsolicited change event."""
+        return self.result is None
+
+    @property
+    def failed(self):
+        """Device reported an error."""
+        return self.result == 'fail'
+
+    @property
+    def under_process(self):
+        """Interim reply, the final reply follows later."""
+        return self.raw_message.startswith(UNDER_PROCESS)
+
+
+def parse_message(message):
+    """Parse 'key=value&flag' message string, percent-decoding values."""
+    result = {}
+    if message:
+        for elem in message.split('&'):
+            key, assign, value = elem.partition('=')
+            if '%' in elem:
+                key, value = unquote(key), unquote(value)
+            result[key] = value if assign else True
+    return result
+
+
+def parse_line(line):
+    """Parse one line received from a Heos device.
+
+    Raises ValueError if the line is not a Heos reply or event.
+    """
+    if not orjson:
+        match = _ENVELOPE.match(line)
+        if match:
+            command, result, message = match.groups()
+            return HeosMessage(command.decode(),
+                               result.decode() if result else None,
+                               message.decode() if message else '', None,
+                               line)
+
+    data = _loads(line)
+    try:
+        heos = data['heos']
+        return HeosMessage(heos['command'], heos.get('result'),
+                           heos.get('message', ''), data.get('payload'), line)
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError('Not a heos message: {!r}'.format(line))
@@ -4,10 +4,21 @@
 from pytz import UTC
 from datetime import datetime
 
+import contextlib
+import fnmatch
 import logging
+import time
 
 _LOGGER = logging.getLogger(__name__)
 
+# fields which can be subscribed to
+FIELDS = ('volume', 'mute', 'play_state', 'duration', 'current_position',
+          'media_artist', 'media_album', 'media_title', 'media_image_url',
+          'player_info')
+
+# ms of drift between reported and extrapolated position seen as a seek
+POSITION_TOLERANCE = 2000
+
 
 class AioHeosPlayer:
     " Asynchronous Heos Player class "
@@ -23,8 +34,12 @@ class AioHeosPlayer:
         self._play_state = None
         self._mute_state = None
         self._volume_level = 0
+        self._volume_target = None
+        self._volume_future = None
         self._current_position = 0
-        self._current_position_updated_at = None
+        self._position_updated_at = None
+        self._position_synced_at = None
+        self._position_notified_at = None
         self._duration = 0
         self._media_artist = None
         self._media_album = None
@@ -32,6 +47,9 @@ class AioHeosPlayer:
         self._media_image_url = None
         self._media_id = None
         self._callback = None
+        self._batch = None
+        self._changed_fields = []
+        self._subscribers = {}
         _LOGGER.debug("[D] Creating player object %s",
                       self._player_id)
 
@@ -69,14 +87,26 @@ class AioHeosPlayer:
 
     @volume.setter
     def volume(self, value):
-        self._volume_level = value
         self._online = True
-        self.notify_listeners()
+        self._update('volume', '_volume_level', value)
 
     @property
     def current_position_updated_at(self):
         " get current_position_updated_at "
-        return self._current_position_updated_at
+        if self._position_updated_at is None:
+            return None
+        return datetime.fromtimestamp(self._position_updated_at, UTC)
+
+    @property
+    def estimated_position(self):
+        """Current position in ms, extrapolated while playing."""
+        if self._play_state != 'play' or self._position_synced_at is None:
+            return self._current_position
+        position = self._current_position + int(
+            (time.monotonic() - self._position_synced_at) * 1000)
+        if self._duration:
+            position = min(position, self._duration)
+        return position
 
     @property
     def duration(self):
@@ -85,8 +115,7 @@ class AioHeosPlayer:
 
     @duration.setter
     def duration(self, duration):
-        self._duration = duration
-        self.notify_listeners()
+        self._update('duration', '_duration', duration)
 
     @property
     def current_position(self):
@@ -95,9 +124,37 @@ class AioHeosPlayer:
 
     @current_position.setter
     def current_position(self, current_position):
-        self._current_position = current_position
-        self._current_position_updated_at = datetime.now(UTC)
-        self.notify_listeners()
+        self._anchor_position(current_position)
+        self._update('current_position', '_current_position',
+                     current_position)
+
+    def _anchor_position(self, position):
+        """Remember when position was last reported."""
+        if position != self._current_position:
+            self._position_updated_at = time.time()
+        self._position_synced_at = time.monotonic()
+
+    def sync_position(self, position, duration, resync,
+                      tolerance=POSITION_TOLERANCE):
+        """Take a progress report, notify only when needed.
+
+        Listeners are notified on track changes, when position drifts more
+        than tolerance ms from the extrapolated position (seek), or when
+        resync seconds passed since the last notification. Otherwise the
+        position is updated silently, use estimated_position to read it.
+        """
+        now = time.monotonic()
+        if (duration != self._duration
+                or self._position_notified_at is None
+                or now - self._position_notified_at >= resync
+                or abs(position - self.estimated_position) > tolerance):
+            self._position_notified_at = now
+            with self.batch_update():
+                self.current_position = position
+                self.duration = duration
+        else:
+            self._anchor_position(position)
+            self._current_position = position
 
     @property
     def mute(self):
@@ -106,8 +163,7 @@ class AioHeosPlayer:
 
     @mute.setter
     def mute(self, value):
-        self._mute_state = value
-        self.notify_listeners()
+        self._update('mute', '_mute_state', value)
 
     @property
     def play_state(self):
@@ -116,9 +172,12 @@ class AioHeosPlayer:
 
     @play_state.setter
     def play_state(self, value):
-        self._play_state = value
         self._online = bool(value)
-        self.notify_listeners()
+        if self._play_state == 'play' and value != 'play':
+            # freeze extrapolated position
+            self._current_position = self.estimated_position
+            self._position_synced_at = time.monotonic()
+        self._update('play_state', '_play_state', value)
 
     @property
     def media_artist(self):
@@ -127,8 +186,7 @@ class AioHeosPlayer:
 
     @media_artist.setter
     def media_artist(self, value):
-        self._media_artist = value
-        self.notify_listeners()
+        self._update('media_artist', '_media_artist', value)
 
     @property
     def media_album(self):
@@ -137,8 +195,7 @@ class AioHeosPlayer:
 
     @media_album.setter
     def media_album(self, value):
-        self._media_album = value
-        self.notify_listeners()
+        self._update('media_album', '_media_album', value)
 
     @property
     def media_title(self):
@@ -147,8 +204,7 @@ class AioHeosPlayer:
 
     @media_title.setter
     def media_title(self, value):
-        self._media_title = value
-        self.notify_listeners()
+        self._update('media_title', '_media_title', value)
 
     @property
     def media_image_url(self):
@@ -157,8 +213,7 @@ class AioHeosPlayer:
 
     @media_image_url.setter
     def media_image_url(self, value):
-        self._media_image_url = value
-        self.notify_listeners()
+        self._update('media_image_url', '_media_image_url', value)
 
     @property
     def media_id(self):
@@ -181,67 +236,77 @@ class AioHeosPlayer:
 
     @player_info.setter
     def player_info(self, info):
-        self._player_info = info
-        self.notify_listeners()
+        self._update('player_info', '_player_info', info)
 
     def toggle_mute(self):
         " toggle mute "
-        self._controller.toggle_mute(self.player_id)
+        return self._controller.toggle_mute(self.player_id)
 
     def set_mute(self, mute):
         " set mute "
-        self._controller.set_mute(self.player_id, mute)
+        return self._controller.set_mute(self.player_id, mute)
 
     def reset_now_playing(self):
         """Reset now playing"""
-        self._media_artist = None
-        self._media_album = None
-        self._media_title = None
-        self._media_image_url = None
-        self._media_id = None
+        with self.batch_update():
+            self.media_artist = None
+            self.media_album = None
+            self.media_title = None
+            self.media_image_url = None
+            self._media_id = None
 
     def request_update(self):
         """Request update"""
-        self._controller.request_play_state(self.player_id)
-        self._controller.request_mute_state(self.player_id)
-        self._controller.request_volume(self.player_id)
-        self._controller.request_now_playing_media(self.player_id)
+        # pylint: disable=protected-access
+        self._controller._queue_refresh([self.player_id])
+
+    async def refresh(self, fields=None):
+        """Refresh state, return once every reply is in"""
+        failures = await self._controller.refresh([self.player_id], fields)
+        if failures:
+            raise failures[self.player_id]
 
     def volume_level_up(self, step=10):
         " volume level up "
-        self.set_volume(self._volume_level + step)
+        return self.set_volume(self._volume_base() + step)
 
     def volume_level_down(self, step=10):
         " volume level down "
-        self.set_volume(self._volume_level - step)
+        return self.set_volume(self._volume_base() - step)
+
+    def _volume_base(self):
+        """Volume to step from, the last requested one while pending"""
+        if self._volume_target is not None:
+            return self._volume_target
+        return self._volume_level
 
     def stop(self):
         " stop player "
-        self._controller.stop(self.player_id)
+        return self._controller.stop(self.player_id)
 
     def play(self):
         " play "
-        self._controller.play(self.player_id)
+        return self._controller.play(self.player_id)
 
     def pause(self):
         " pause "
-        self._controller.pause(self.player_id)
+        return self._controller.pause(self.player_id)
 
     def play_next(self):
         " next "
-        self._controller.request_play_next(self.player_id)
+        return self._controller.request_play_next(self.player_id)
 
     def play_prev(self):
         " prev "
-        self._controller.request_play_previous(self.player_id)
+        return self._controller.request_play_previous(self.player_id)
 
     def play_favorite(self, fav_mid):
         " Favorites "
-        self._controller.play_favourite(self.player_id, fav_mid)
+        return self._controller.play_favourite(self.player_id, fav_mid)
 
     def play_stream(self, sid, mid):
         " Favorites "
-        self._controller.play_stream(self.player_id, sid, mid)
+        return self._controller.play_stream(self.player_id, sid, mid)
 
     def play_source(self, source):
         " Sourced "
@@ -251,7 +316,16 @@ class AioHeosPlayer:
 
     def set_volume(self, volume):
         """Set volume"""
-        self._controller.set_volume(volume, self.player_id)
+        future = self._controller.set_volume(volume, self.player_id)
+        self._volume_target = min(100, max(0, volume))
+        self._volume_future = future
+        future.add_done_callback(self._volume_set)
+        return future
+
+    def _volume_set(self, future):
+        if future is self._volume_future:
+            self._volume_target = None
+            self._volume_future = None
 
     def source_list(self):
         """Source list"""
@@ -264,7 +338,7 @@ class AioHeosPlayer:
     def create_group(self, devices):
         """Create group"""
         slave_ids = [slave for slave in devices if slave != self.player_id]
-        self._controller.set_group(self.player_id, slave_ids)
+        return self._controller.set_group(self.player_id, slave_ids)
 
     @property
     def sid(self):
@@ -293,7 +367,90 @@ class AioHeosPlayer:
     def qid(self, value):
         self._qid = value
 
-    def notify_listeners(self):
+    @property
+    def changed_fields(self):
+        """Fields changed by the update being notified"""
+        return self._changed_fields
+
+    def subscribe(self, field, callback):
+        """Subscribe callback(player, field, old, new) to field changes.
+
+        field is one of FIELDS or a wildcard such as '*' or 'media_*'.
+        Returns a function which removes the subscription again.
+        """
+        fields = fnmatch.filter(FIELDS, field)
+        if not fields:
+            raise ValueError('Unknown field {}'.format(field))
+        token = object()
+        for name in fields:
+            self._subscribers.setdefault(name, {})[token] = callback
+
+        def unsubscribe():
+            for name in fields:
+                callbacks = self._subscribers.get(name)
+                if callbacks is None:
+                    continue
+                callbacks.pop(token, None)
+                if not callbacks:
+                    del self._subscribers[name]
+
+        return unsubscribe
+
+    def _update(self, field, attr, value):
+        """Set attribute, notify listeners unless unchanged or batched"""
+        old = getattr(self, attr)
+        if old == value:
+            return
+        setattr(self, attr, value)
+        if self._batch is not None:
+            if field in self._batch:
+                self._batch[field][1] = value
+            else:
+                self._batch[field] = [old, value]
+        else:
+            self._notify({field: (old, value)})
+
+    @contextlib.contextmanager
+    def batch_update(self):
+        """Apply several updates and notify listeners once.
+
+        Assignments which do not change a value are skipped, and listeners
+        are notified once at the end with the list of changed fields.
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = {}
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            changes = {field: (old, new)
+                       for field, (old, new) in batch.items() if old != new}
+            if changes:
+                self._notify(changes)
+
+    def _notify(self, changes):
+        """Fan out changes to field subscribers, then notify listeners"""
+        if self._subscribers:
+            for field, (old, new) in changes.items():
+                callbacks = self._subscribers.get(field)
+                if callbacks:
+                    for callback in list(callbacks.values()):
+                        try:
+                            callback(self, field, old, new)
+                        except Exception:    # pylint: disable=broad-except
+                            _LOGGER.exception('[E] Subscriber to %s failed',
+                                              field)
+        self.notify_listeners(list(changes))
+
+    def notify_listeners(self, changed_fields=None):
         """Notify listeners"""
+        self._changed_fields = changed_fields or []
+        # pylint: disable=protected-access
+        self._controller._mark_changed(self)
         if self._callback:
-            self._callback()
+            try:
+                self._callback()
+            except Exception:    # pylint: disable=broad-except
+                _LOGGER.exception('[E] State change callback failed')
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Heos CLI proxy, many local clients over one device connection."""
+
+import asyncio
+import functools
+import json
+import logging
+from concurrent.futures import CancelledError
+from urllib.parse import quote
+
+from . import aioheoscontroller
+from . import aioheosevents
+from . import aioheosmessage
+
+_LOGGER = logging.getLogger(__name__)
+
+# bytes buffered for a client before events to it are dropped
+MAX_CLIENT_BUFFER = 2**20
+
+# heos cli error id for failures of the proxy itself
+INTERNAL_ERROR = 11
+
+# answered by the proxy, not sent to the device
+LOCAL_COMMANDS = frozenset(
+    (aioheoscontroller.SYSTEM_REGISTER_FOR_EVENTS,
+     aioheoscontroller.SYSTEM_PRETTIFY, aioheoscontroller.SYSTEM_HEART_BEAT))
+
+
+def _reply_line(command, result, message):
+    """Encode a reply the way a Heos device sends it."""
+    return (json.dumps({
+        'heos': {
+            'command': command,
+            'result': result,
+            'message': message
+        }
+    }) + '\r\n').encode()
+
+
+def _with_sequence(record, sequence):
+    """Line of record with the sequence of the client, or none."""
+    line = record.line
+    ours = record.message.get(aioheoscontroller.SEQUENCE)
+    if ours is None:
+        return line
+    ours = '{}={}'.format(aioheoscontroller.SEQUENCE, ours).encode()
+    if sequence is not None:
+        return line.replace(
+            ours, '{}={}'.format(aioheoscontroller.SEQUENCE,
+                                 sequence).encode(), 1)
+    for argument in (b'&' + ours, ours + b'&', ours):
+        if argument in line:
+            return line.replace(argument, b'', 1)
+    return line
+
+
+class _ProxyClient:
+    """Local client connection."""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, writer):
+        self.writer = writer
+        self.events = False
+        self.dropped = 0
+
+    def write(self, data):
+        """Write unless the client went away."""
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class AioHeosProxy:
+    """Share the connection of a controller with local Heos CLI clients.
+
+    Clients speak the heos:// line protocol as to a device. Commands are
+    sent through the controller and replies go back to the client which
+    asked, events go to every client registered for change events.
+    Identical concurrent get_ commands are sent to the device once and
+    the reply is shared. Event registration, prettify and heart beats are
+    answered by the proxy itself, replies are never prettified. A SEQUENCE
+    argument of a client is given back in its reply.
+    """
+
+    def __init__(self, loop, controller, host=None,
+                 port=aioheoscontroller.HEOS_PORT,
+                 max_buffer=MAX_CLIENT_BUFFER):
+        self._loop = loop
+        self._controller = controller
+        self._host = host
+        self._port = port
+        self._max_buffer = max_buffer
+        self._server = None
+        self._events = None
+        self._event_task = None
+        self._clients = set()
+        self._reads = {}
+
+    @property
+    def port(self):
+        """Port listened on."""
+        if self._server and self._server.sockets:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    @property
+    def clients(self):
+        """Number of connected clients."""
+        return len(self._clients)
+
+    async def start(self):
+        """Start accepting clients."""
+        # forwarding never waits, so blocking only holds back the
+        # controller while events are written out
+        self._events = self._controller.events(
+            maxsize=1000, policy=aioheosevents.BLOCK)
+        self._event_task = self._loop.create_task(self._forward_events())
+        self._server = await asyncio.start_server(self._handle_client,
+                                                  self._host, self._port)
+        _LOGGER.info('[I] Proxy listening on port %s', self.port)
+
+    async def close(self):
+        " close "
+        if self._server:
+            self._server.close()
+        for client in list(self._clients):
+            client.writer.close()
+        if self._events:
+            self._events.close()
+        if self._event_task:
+            self._event_task.cancel()
+            try:
+                await self._event_task
+            except asyncio.CancelledError:
+                pass
+        if self._server:
+            await self._server.wait_closed()
+
+    async def _forward_events(self):
+        """Fan out events to the clients registered for them."""
+        async for record in self._events:
+            for client in self._clients:
+                if not client.events:
+                    continue
+                buffered = client.writer.transport.get_write_buffer_size()
+                if buffered > self._max_buffer:
+                    if not client.dropped:
+                        _LOGGER.warning('[W] Client too slow, dropping '
+                                        'events')
+                    client.dropped += 1
+                    continue
+                client.write(record.line)
+
+    async def _handle_client(self, reader, writer):
+        """Read commands of one client."""
+        client = _ProxyClient(writer)
+        self._clients.add(client)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._handle_line(client, line)
+        except (GeneratorExit, CancelledError):
+            pass
+        except OSError:
+            _LOGGER.debug('[D] Client connection lost', exc_info=True)
+        finally:
+            self._clients.discard(client)
+            writer.close()
+
+    def _handle_line(self, client, line):
+        """Answer locally, or send to the device."""
+        text = line.decode('ascii', 'replace').strip()
+        if not text.startswith('heos://'):
+            if text:
+                client.write(
+                    _reply_line('', 'fail',
+                                'eid=1&text=Unrecognized Command'))
+            return
+        command, _, raw_message = text[len('heos://'):].partition('?')
+        message = aioheosmessage.parse_message(raw_message)
+
+        if command == aioheoscontroller.SYSTEM_REGISTER_FOR_EVENTS:
+            client.events = message.get('enable') == 'on'
+        if command in LOCAL_COMMANDS:
+            client.write(_reply_line(command, 'success', raw_message))
+            return
+
+        # the controller pairs replies by sequences of its own
+        sequence = message.pop(aioheoscontroller.SEQUENCE, None)
+        future = self._request(command, message)
+        future.add_done_callback(
+            functools.partial(self._reply, client, command, raw_message,
+                              sequence))
+
+    def _request(self, command, message):
+        """Send command, sharing identical get_ commands in flight."""
+        if not command.partition('/')[2].startswith('get_'):
+            return self._controller.send_command(command, message)
+        key = (command, tuple(message.items()))
+        future = self._reads.get(key)
+        if future is None:
+            future = self._controller.send_command(command, message)
+            self._reads[key] = future
+            future.add_done_callback(lambda _: self._reads.pop(key, None))
+        return future
+
+    @staticmethod
+    def _reply(client, command, raw_message, sequence, future):
+        """Pass the reply of the device on to the client."""
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is None:
+            client.write(_with_sequence(future.result(), sequence))
+        elif getattr(exc, 'record', None) is not None:
+            # error reported by the device
+            client.write(_with_sequence(exc.record, sequence))
+        else:
+            message = 'eid={}&text={}'.format(
+                INTERNAL_ERROR, quote(str(getattr(exc, 'message', exc))))
+            if raw_message:
+                message += '&' + raw_message
+            client.write(_reply_line(command, 'fail', message))
@@ -8,10 +8,18 @@ TODO:
 
 """
 
+import abc
 import asyncio
+import ipaddress
+import json
 import logging
+import mmap
+import os
 import socket
+import time
+from http import HTTPStatus
 from time import gmtime, strftime
+from urllib.parse import urljoin, urlsplit
 
 import aiohttp
 import lxml.etree
@@ -24,6 +32,28 @@ DENON_DEVICE = 'urn:schemas-denon-com:device:AiosDevice:1'    # for dlna
 MEDIA_DEVICE = 'urn:schemas-upnp-org:device:MediaRenderer:1'
 AVTRANSPORT_SERVICE = 'urn:schemas-upnp-org:service:AVTransport:1'
 
+DEVICE_NAMESPACE = {'n': 'urn:schemas-upnp-org:device-1-0'}
+# urls of a service in a device description
+SERVICE_URLS = ('controlURL', 'eventSubURL', 'SCPDURL')
+
+# bytes written at a time of content in memory or streamed
+CONTENT_CHUNK = 2**16
+# longest request line and headers accepted by PlayContentServer
+MAX_REQUEST_HEAD = 2**13
+
+# seconds devices may wait before answering a search
+DISCOVERY_MX = 3
+# lifetime in seconds of search results without a max-age
+DISCOVERY_MAX_AGE = 1800
+# seconds between background searches while cached results are used
+DISCOVERY_REFRESH = 300
+
+# http connections kept per device, seconds idle ones are kept open, and
+# seconds a soap action or description fetch may take
+HTTP_LIMIT_PER_HOST = 2
+HTTP_KEEPALIVE = 30
+HTTP_TIMEOUT = 10
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -35,6 +65,24 @@ def _get_ipaddress():
     return ipaddress
 
 
+async def resolve(loop, host):
+    """ return the set of addresses of host, devices announce themselves
+    by address """
+    addresses = {host}
+    try:
+        ipaddress.ip_address(host)
+        return addresses
+    except ValueError:
+        pass
+    try:
+        infos = await loop.getaddrinfo(host, None)
+    except OSError as exc:
+        _LOGGER.warning('[W] Unable to resolve %s: %s', host, exc)
+        return addresses
+    addresses.update(info[4][0] for info in infos)
+    return addresses
+
+
 class HttpException(Exception):
     """HttpException class."""
 
@@ -126,7 +174,8 @@ class HttpResponse():
 
     def get_status(self):
         " get status "
-        return "HTTP/1.1 {status} OK\r\n".format(status=self._status)
+        return "HTTP/1.1 {status} {reason}\r\n".format(
+            status=self._status, reason=HTTPStatus(self._status).phrase)
 
 
 class UpnpException(Exception):
@@ -137,40 +186,309 @@ class UpnpException(Exception):
         self.message = message
 
 
+class SsdpDevice():
+    """Device found by an SSDP search."""
+
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, usn, search_target, location, expires, boot_id=None,
+                 config_id=None):
+        self.usn = usn
+        self.search_target = search_target
+        self.location = location
+        self.expires = expires
+        self.boot_id = boot_id
+        self.config_id = config_id
+
+    def __repr__(self):
+        return 'SsdpDevice({!r}, {!r})'.format(self.usn, self.location)
+
+    @property
+    def host(self):
+        """ return host of the device """
+        return urlsplit(self.location).hostname
+
+    @classmethod
+    def from_headers(cls, headers, now=None):
+        """ create from search reply or notify headers """
+        max_age = DISCOVERY_MAX_AGE
+        for directive in headers.get('cache-control', '').split(','):
+            key, _, value = directive.partition('=')
+            if key.strip().lower() == 'max-age' and value.strip().isdigit():
+                max_age = int(value)
+        return cls(headers.get('usn') or headers['location'],
+                   headers.get('st') or headers.get('nt'),
+                   headers['location'], (now or time.time()) + max_age,
+                   headers.get('bootid.upnp.org'),
+                   headers.get('configid.upnp.org'))
+
+
+def _parse_ssdp(data):
+    """ split a ssdp message in start line and lower cased headers """
+    content = data.decode(errors='replace').split('\r\n')
+    headers = {}
+    for item in content[1:]:
+        key, sep, value = item.partition(':')
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    return content[0], headers
+
+
+class _FileCache(abc.ABC):
+    """Cache, optionally kept in a JSON file.
+
+    The file is read on first use and replaced on every change.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._loaded = path is None
+
+    @abc.abstractmethod
+    def _from_json(self, data):
+        """ fill the cache from data read """
+
+    @abc.abstractmethod
+    def _to_json(self):
+        """ return the cache as data to write """
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self._path) as fcache:
+                self._from_json(json.load(fcache))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            _LOGGER.warning('[W] Ignoring cache %s', self._path,
+                            exc_info=True)
+
+    def _save(self):
+        if not self._path:
+            return
+        tmp = self._path + '.tmp'
+        try:
+            with open(tmp, 'w') as fcache:
+                json.dump(self._to_json(), fcache)
+            os.replace(tmp, self._path)
+        except OSError:
+            _LOGGER.warning('[W] Unable to write cache %s', self._path,
+                            exc_info=True)
+
+
+class DiscoveryCache(_FileCache):
+    """SSDP search results by USN, kept until they expire.
+
+    With path set the results are kept in a JSON file as well, so a
+    restart finds the devices without waiting for a search.
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._devices = {}
+        self.searched_at = None
+
+    def _from_json(self, data):
+        self.searched_at = data['searched_at']
+        for device in data['devices']:
+            device = SsdpDevice(**device)
+            self._devices[device.usn] = device
+
+    def _to_json(self):
+        return {
+            'searched_at': self.searched_at,
+            'devices': [vars(device) for device in self._devices.values()]
+        }
+
+    def devices(self, search_target=None):
+        """ return unexpired devices, optionally of one search target """
+        if not self._loaded:
+            self._load()
+        now = time.time()
+        return [
+            device for device in self._devices.values()
+            if device.expires > now and (search_target is None or
+                                         device.search_target == search_target)
+        ]
+
+    def update(self, devices):
+        """ add search results, forget expired ones """
+        if not self._loaded:
+            self._load()
+        now = time.time()
+        self.searched_at = now
+        for device in devices:
+            self._devices[device.usn] = device
+        for usn, device in list(self._devices.items()):
+            if device.expires <= now:
+                del self._devices[usn]
+        self._save()
+
+
+class DeviceDescription():
+    """Services of a device, parsed from its description.
+
+    services maps service types to their SERVICE_URLS as given, use
+    service_url for absolute ones.
+    """
+
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, url, udn, base, services, boot_id=None,
+                 config_id=None):
+        self.url = url
+        self.udn = udn
+        self.base = base
+        self.services = services
+        self.boot_id = boot_id
+        self.config_id = config_id
+
+    def __repr__(self):
+        return 'DeviceDescription({!r}, {!r})'.format(self.udn, self.url)
+
+    def service_url(self, service, kind='controlURL'):
+        """ return absolute url of kind for service """
+        try:
+            return urljoin(self.base, self.services[service][kind])
+        except KeyError:
+            raise UpnpException('Cant find {} of {}'.format(kind, service))
+
+    @classmethod
+    def from_xml(cls, url, content, boot_id=None, config_id=None):
+        """ parse a device description """
+        # pylint: disable=no-member
+        xml = lxml.etree.fromstring(content)
+        base = xml.xpath('/n:root/n:URLBase/text()',
+                         namespaces=DEVICE_NAMESPACE)
+        udn = xml.xpath('/n:root/n:device/n:UDN/text()',
+                        namespaces=DEVICE_NAMESPACE)
+        services = {}
+        for service in xml.xpath('//n:service', namespaces=DEVICE_NAMESPACE):
+            service_type = service.findtext('n:serviceType',
+                                            namespaces=DEVICE_NAMESPACE)
+            services[service_type] = {
+                kind: service.findtext('n:' + kind,
+                                       namespaces=DEVICE_NAMESPACE)
+                for kind in SERVICE_URLS
+            }
+        return cls(url, udn[0].strip() if udn else None,
+                   base[0].strip() if base else url, services, boot_id,
+                   config_id)
+
+
+class DescriptionCache(_FileCache):
+    """Device descriptions by description url and UDN.
+
+    A description is dropped once the device announces a BOOTID or
+    CONFIGID other than the one it was fetched under, see observe. With
+    path set the descriptions are kept in a JSON file as well.
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._by_url = {}
+        self._by_udn = {}
+
+    def _from_json(self, data):
+        for description in data['descriptions']:
+            self._add(DeviceDescription(**description))
+
+    def _to_json(self):
+        return {
+            'descriptions':
+            [vars(description) for description in self._by_url.values()]
+        }
+
+    def _add(self, description):
+        self._by_url[description.url] = description
+        if description.udn:
+            self._by_udn[description.udn] = description
+
+    def _drop(self, description):
+        _LOGGER.debug('[D] Dropping description %s', description)
+        del self._by_url[description.url]
+        if self._by_udn.get(description.udn) is description:
+            del self._by_udn[description.udn]
+        self._save()
+
+    def get(self, url=None, udn=None):
+        """ return description by url or udn, None if not cached """
+        if not self._loaded:
+            self._load()
+        if url is not None:
+            return self._by_url.get(url)
+        return self._by_udn.get(udn)
+
+    def put(self, description):
+        """ add a description """
+        if not self._loaded:
+            self._load()
+        old = self._by_url.get(description.url)
+        if old is not None and old.udn != description.udn:
+            self._by_udn.pop(old.udn, None)
+        self._add(description)
+        self._save()
+
+    def observe(self, device):
+        """ drop the description of a SsdpDevice booted or reconfigured
+        since it was fetched """
+        description = self.get(device.location)
+        if description is None:
+            return
+        for seen, cached in ((device.boot_id, description.boot_id),
+                             (device.config_id, description.config_id)):
+            if seen is not None and seen != cached:
+                self._drop(description)
+                return
+
+
 class Upnp():
     " Upnp class "
 
     # pylint: disable=redefined-outer-name
-    def __init__(self, loop, ssdp_host=SSDP_HOST, ssdp_port=SSDP_PORT):
+    def __init__(self, loop, ssdp_host=SSDP_HOST, ssdp_port=SSDP_PORT,
+                 session=None):
         self._loop = loop
         self._ssdp_host = ssdp_host
         self._ssdp_port = ssdp_port
         self._url = None
-        # Backward compat
-        if hasattr(asyncio, 'ensure_future'):
-            self._asyncio_ensure_future = getattr(asyncio, 'ensure_future')
-        else:
-            self._asyncio_ensure_future = getattr(asyncio, 'async')
+        # closed by close() unless given
+        self._session = session
+        self._own_session = session is None
+
+    def _get_session(self):
+        """ return the http session, connections are kept alive """
+        if self._own_session and (self._session is None
+                                  or self._session.closed):
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=HTTP_LIMIT_PER_HOST,
+                    keepalive_timeout=HTTP_KEEPALIVE),
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+        return self._session
+
+    async def close(self):
+        """ close the http session """
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
 
     class DiscoverProtocol:
-        """ Discovery Protocol """
+        """ Discovery Protocol, collects search replies by USN """
 
-        def __init__(self, upnp, future, search_target):
+        def __init__(self, upnp, search_target, mx=DISCOVERY_MX,
+                     on_device=None):
             self._upnp = upnp
-            self._future = future
             self._search_target = search_target
+            self._mx = mx
+            self._on_device = on_device
             self._transport = None
+            self.devices = {}
 
         def connection_made(self, transport):
             """ Protocol connection made """
             _LOGGER.debug('Connection made')
             self._transport = transport
             sock = self._transport.get_extra_info('socket')
-            # sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.settimeout(2)
             sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-            sock.bind(('', self._upnp.ssdp_port))
 
             tmpl = (
                 'M-SEARCH * HTTP/1.1',
@@ -178,55 +496,197 @@ class Upnp():
                 str(self._upnp.ssdp_port),
                 'Man: "ssdp:discover"',
                 'ST: {}'.format(self._search_target),
-                # 'ST: ssdp:all',
-                'MX: 3',
+                'MX: {}'.format(self._mx),
                 '',
                 '')
 
             msg = "\r\n".join(tmpl).encode('ascii')
-            self._transport.sendto(
-                msg, (self._upnp.ssdp_host, self._upnp.ssdp_port))
+            # udp, so ask twice
+            for _ in range(2):
+                self._transport.sendto(
+                    msg, (self._upnp.ssdp_host, self._upnp.ssdp_port))
 
         def datagram_received(self, data, _):
             """ datagram received """
-            content = data.decode().rsplit('\r\n')
-
-            # sock = self._transport.get_extra_info('socket')
-            # if content[0].startswith('NOTIFY'):
-            if content[0] == 'HTTP/1.1 200 OK':
-                # pylint: disable=line-too-long
-                reply = {
-                    k.lower(): v
-                    for k, v in
-                    [item.split(': ') for item in content if ": " in item]
-                }
-                _LOGGER.debug(reply['st'])
-                if reply['st'] == self._search_target:
-                    url = reply['location']
-                    self._future.set_result(url)
-                    self._transport.close()
+            start, reply = _parse_ssdp(data)
+            if not start.startswith('HTTP/1.1 200'):
+                return
+            if reply.get('st') != self._search_target \
+                    or 'location' not in reply:
+                return
+            device = SsdpDevice.from_headers(reply)
+            _LOGGER.debug('[D] Found %s', device)
+            if device.usn not in self.devices:
+                self.devices[device.usn] = device
+                if self._on_device:
+                    self._on_device(device)
 
         def error_received(self, exc):    # pylint: disable=no-self-use
             """ error received """
-            _LOGGER.error('[E] Error received: ', exc)
+            _LOGGER.error('[E] Error received: %s', exc)
 
         def connection_lost(self, _):
             """ connection lost """
-            _LOGGER.warning("[I] Connection lost.")
-            self._transport.close()
+            _LOGGER.debug("[D] Connection lost.")
+
+    class NotifyProtocol:
+        """ Notify Protocol, keeps a table of live devices by UUID and type
+
+        A device announces itself once per type, and arrives and departs
+        once per type. Devices are added on ssdp:alive and removed on
+        ssdp:byebye or when the max-age of their last announcement passed.
+        """
+
+        def __init__(self, loop, notification_types, on_arrival=None,
+                     on_departure=None, descriptions=None):
+            self._loop = loop
+            self._descriptions = descriptions
+            self._notification_types = frozenset(notification_types)
+            self._on_arrival = on_arrival
+            self._on_departure = on_departure
+            self._transport = None
+            self._expiry = None
+            self.devices = {}
+
+        def connection_made(self, transport):
+            """ Protocol connection made """
+            self._transport = transport
+
+        def datagram_received(self, data, _):
+            """ datagram received """
+            start, notify = _parse_ssdp(data)
+            if not start.startswith('NOTIFY') \
+                    or notify.get('nt') not in self._notification_types:
+                return
+            uuid = notify.get('usn', '').partition('::')[0]
+            if not uuid:
+                return
+            key = (uuid, notify['nt'])
+            if notify.get('nts') == 'ssdp:alive' and 'location' in notify:
+                self._alive(key, SsdpDevice.from_headers(notify))
+            elif notify.get('nts') == 'ssdp:byebye':
+                self._departed(key)
+
+        def _alive(self, key, device):
+            known = self.devices.get(key)
+            self.devices[key] = device
+            if self._descriptions is not None:
+                self._descriptions.observe(device)
+            if known is None or known.location != device.location \
+                    or known.boot_id != device.boot_id:
+                _LOGGER.debug('[D] Device arrived %s', device)
+                if self._on_arrival:
+                    self._on_arrival(device)
+            self._schedule_expiry()
+
+        def _departed(self, key):
+            device = self.devices.pop(key, None)
+            if device is None:
+                return
+            _LOGGER.debug('[D] Device departed %s', device)
+            if self._on_departure:
+                self._on_departure(device)
+            self._schedule_expiry()
+
+        def _schedule_expiry(self):
+            if self._expiry:
+                self._expiry.cancel()
+                self._expiry = None
+            if self.devices:
+                expires = min(device.expires
+                              for device in self.devices.values())
+                self._expiry = self._loop.call_later(
+                    max(0, expires - time.time()), self._expire)
+
+        def _expire(self):
+            self._expiry = None
+            now = time.time()
+            for key, device in list(self.devices.items()):
+                if device.expires <= now:
+                    self._departed(key)
+            self._schedule_expiry()
+
+        def error_received(self, exc):    # pylint: disable=no-self-use
+            """ error received """
+            _LOGGER.error('[E] Error received: %s', exc)
 
-    async def discover(self, search_target, _addr=None):
-        " search "
-        future = asyncio.Future()
-        self._asyncio_ensure_future(
-            self._loop.create_datagram_endpoint(
-                lambda: Upnp.DiscoverProtocol(
-                    self, future, search_target
-                ),
-                family=socket.AF_INET,
-                proto=socket.IPPROTO_UDP))
-        await future
-        self._url = future.result()
+        def connection_lost(self, _):
+            """ connection lost """
+            if self._expiry:
+                self._expiry.cancel()
+                self._expiry = None
+
+        def close(self):
+            """ stop listening """
+            if self._transport:
+                self._transport.close()
+
+    async def listen(self, on_arrival=None, on_departure=None,
+                     notification_types=(DENON_DEVICE, MEDIA_DEVICE),
+                     descriptions=None):
+        """Listen for device announcements, return the NotifyProtocol.
+
+        on_arrival and on_departure are called with the SsdpDevice, also
+        when a device rebooted. Descriptions in the DescriptionCache
+        descriptions are dropped once outdated. Call close on the protocol
+        to stop listening.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', self._ssdp_port))
+            if ipaddress.ip_address(self._ssdp_host).is_multicast:
+                membership = socket.inet_aton(
+                    self._ssdp_host) + socket.inet_aton('0.0.0.0')
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                membership)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        _, protocol = await self._loop.create_datagram_endpoint(
+            lambda: Upnp.NotifyProtocol(self._loop, notification_types,
+                                        on_arrival, on_departure,
+                                        descriptions),
+            sock=sock)
+        return protocol
+
+    async def search(self, search_target, mx=DISCOVERY_MX, on_device=None):
+        """Search devices, return a SsdpDevice for every device answering
+        within mx seconds. on_device is called for each as it answers.
+        """
+        transport, protocol = await self._loop.create_datagram_endpoint(
+            lambda: Upnp.DiscoverProtocol(self, search_target, mx, on_device),
+            local_addr=('0.0.0.0', 0),
+            family=socket.AF_INET,
+            proto=socket.IPPROTO_UDP)
+        try:
+            # answers are spread over mx seconds, allow for the network
+            await asyncio.sleep(mx + 0.5)
+        finally:
+            transport.close()
+        return list(protocol.devices.values())
+
+    async def discover(self, search_target, _addr=None, mx=DISCOVERY_MX):
+        " search, return the location of the first device answering "
+        found = self._loop.create_future()
+
+        def on_device(device):
+            if not found.done():
+                found.set_result(device.location)
+
+        search = self._loop.create_task(
+            self.search(search_target, mx, on_device))
+        await asyncio.wait([found, search],
+                           return_when=asyncio.FIRST_COMPLETED)
+        search.cancel()
+        if not found.done():
+            found.cancel()
+            raise UpnpException('No {} found'.format(search_target))
+        self._url = found.result()
         return self._url
 
     async def discover_mediarenderer(self, addr=None):
@@ -252,37 +712,49 @@ class Upnp():
         }
 
         content = ''
-        with aiohttp.ClientSession(loop=self._loop) as session:
-            response = await session.post(url, data=body, headers=headers)
+        async with self._get_session().post(
+                url, data=body, headers=headers) as response:
             if response.status == 200:
                 content = await response.read()
-            await response.release()
 
         _LOGGER.debug(content)
         return content
 
-    async def query_renderer(self, service, url=None):
-        " query renderer "
+    async def query_description(self, url=None, cache=None, device=None):
+        """Return the DeviceDescription at url, from cache if there.
+
+        device is the SsdpDevice at url if known, its BOOTID and CONFIGID
+        are checked against the cached description and stored with a
+        fetched one.
+        """
         if not url:
             url = self._url
-
-        # query renderer
-        with aiohttp.ClientSession(loop=self._loop) as session:
-            response = await session.get(url)
-            if response.status == 200:
-                content = await response.read()
-            await response.release()
-
-        # parse
-        xml = lxml.etree.fromstring(content)    # pylint: disable=no-member
-        # print(lxml.etree.tostring(xml, pretty_print=True).decode())
-        xpath_search = '//n:service[n:serviceType="{}"]/n:controlURL/text()'.format(
-            service)
-        path = xml.xpath(
-            xpath_search, namespaces={'n': 'urn:schemas-upnp-org:device-1-0'})
+        if cache is not None:
+            if device is not None:
+                cache.observe(device)
+            description = cache.get(url)
+            if description is not None:
+                return description
+
+        async with self._get_session().get(url) as response:
+            if response.status != 200:
+                raise UpnpException('Cant query renderer, status {}'.format(
+                    response.status))
+            content = await response.read()
+
+        description = DeviceDescription.from_xml(
+            url, content, device.boot_id if device else None,
+            device.config_id if device else None)
+        if cache is not None:
+            cache.put(description)
+        return description
+
+    async def query_renderer(self, service, url=None, cache=None):
+        " query renderer, return the control url of service as given "
+        description = await self.query_description(url, cache)
         try:
-            return path[0]
-        except TypeError:
+            return description.services[service]['controlURL']
+        except KeyError:
             raise UpnpException('Cant find renderer')
 
     async def set_avtransport_uri(self, uri, url=None):
@@ -333,67 +805,462 @@ class Upnp():
         return self._ssdp_port
 
 
+def _parse_request(head):
+    """ return method, target, version and headers of a request head,
+    raise ValueError if malformed """
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/'):
+        raise ValueError('Not http: {!r}'.format(lines[0]))
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise ValueError('Bad header: {!r}'.format(line))
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def _parse_range(value, size):
+    """ return start and end of a single byte range, None if the range
+    is invalid or multiple so the whole content is to be sent """
+    unit, _, spec = value.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or ',' in spec or not dash:
+        return None
+    try:
+        if not first:
+            return max(0, size - int(last)), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if last and end <= start:
+        return None
+    return start, min(end, size)
+
+
+class _BufferContent():
+    """ content in memory, sent in slices without copying """
+
+    def __init__(self, data):
+        self._data = memoryview(data).cast('B')
+        self.size = len(self._data)
+
+    async def send(self, server, start, end):
+        " send bytes start to end "
+        for offset in range(start, end, CONTENT_CHUNK):
+            await server.drain()
+            server.write(self._data[offset:min(offset + CONTENT_CHUNK, end)])
+
+
+class _FileContent():
+    """ content of a file, sent with sendfile or else memory mapped """
+
+    def __init__(self, path):
+        self._path = path
+        self.size = os.path.getsize(path)
+
+    async def send(self, server, start, end):
+        " send bytes start to end "
+        if end <= start:
+            return
+        with open(self._path, 'rb') as fcontent:
+            try:
+                await server.sendfile(fcontent, start, end - start)
+                return
+            except asyncio.SendfileNotAvailableError:
+                pass
+            # the map lives on in the transport buffer until written
+            content = _BufferContent(
+                mmap.mmap(fcontent.fileno(), 0, access=mmap.ACCESS_READ))
+        await content.send(server, start, end)
+
+
+class _StreamContent():
+    """ content of an async iterator of bytes, of unknown size and sent
+    once """
+
+    size = None
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def take(self):
+        " return the iterator, None once taken "
+        chunks, self._chunks = self._chunks, None
+        return chunks
+
+    @staticmethod
+    async def send(server, chunks, chunked):
+        " send chunks, with chunked transfer encoding if chunked "
+        try:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                await server.drain()
+                if chunked:
+                    server.writelines(
+                        (b'%x\r\n' % len(chunk), chunk, b'\r\n'))
+                else:
+                    server.write(chunk)
+            if chunked:
+                server.write(b'0\r\n\r\n')
+        finally:
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+
+
+def _content_source(content):
+    """ wrap content for PlayContentServer """
+    if isinstance(content, (_BufferContent, _FileContent, _StreamContent)):
+        return content
+    if isinstance(content, (str, os.PathLike)):
+        return _FileContent(content)
+    if hasattr(content, '__aiter__'):
+        return _StreamContent(content)
+    return _BufferContent(content)
+
+
 class PlayContentServer(asyncio.Protocol):
-    """ Play Content Server """
+    """ Play Content Server
+
+    Serves content over http. content is a bytes-like object, served from
+    memory, a file path, served with sendfile, or an async iterator of
+    bytes, served as it comes with chunked transfer encoding, once. GET
+    and HEAD requests are answered, ranges too for content of known size.
+    Writing waits while the transport is paused, so content is never
+    buffered whole. Requests on a connection are answered in turn.
+    """
 
     def __init__(self, content, content_type):
-        self._content = content
+        self._content = _content_source(content)
         self._content_type = content_type
         self._transport = None
+        self._buffer = b''
+        self._task = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._closed = False
 
     def connection_made(self, transport):
         self._transport = transport
 
-    def data_received(self, data):
-        # dont care of request, sent data anyway...
-        _LOGGER.debug(data)
+    def connection_lost(self, exc):
+        self._closed = True
+        self._writable.set()
+        if self._task:
+            self._task.cancel()
 
-        response = HttpResponse(200)
-        # response.add_header('Content-Length', content.getbuffer().nbytes)
-        response.add_header('Content-Length', len(self._content))
-        response.add_header('Content-Type', self._content_type)
-        headers = response.get_status() + response.get_headers() + '\r\n'
-        self._transport.write(headers.encode() + self._content)
-        self._transport.close()
+    def pause_writing(self):
+        self._writable.clear()
 
+    def resume_writing(self):
+        self._writable.set()
+
+    def data_received(self, data):
+        self._buffer += data
+        self._next_request()
+
+    async def drain(self):
+        " wait until the transport takes more data "
+        await self._writable.wait()
+        if self._closed:
+            raise ConnectionResetError('Connection lost')
+
+    def write(self, data):
+        " write data "
+        self._transport.write(data)
+
+    def writelines(self, data):
+        " write a sequence of data "
+        self._transport.writelines(data)
+
+    async def sendfile(self, fcontent, offset, count):
+        " send count bytes of file fcontent from offset "
+        await asyncio.get_event_loop().sendfile(
+            self._transport, fcontent, offset, count, fallback=False)
+
+    def _next_request(self):
+        if self._task is not None:
+            return
+        self._buffer = self._buffer.lstrip(b'\r\n')
+        head, sep, rest = self._buffer.partition(b'\r\n\r\n')
+        if not sep:
+            if len(self._buffer) > MAX_REQUEST_HEAD:
+                self._send_head(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+                                {'Content-Length': 0}, False)
+                self._transport.close()
+            return
+        self._buffer = rest
+        # pipelined requests wait in the socket
+        self._transport.pause_reading()
+        self._task = asyncio.get_event_loop().create_task(
+            self._respond(head))
+        self._task.add_done_callback(self._responded)
+
+    def _responded(self, task):
+        self._task = None
+        if task.cancelled() or self._closed:
+            return
+        if task.exception() is not None:
+            if not isinstance(task.exception(), ConnectionError):
+                _LOGGER.error('[E] Serving content failed: %s',
+                              task.exception())
+            self._transport.close()
+        elif not task.result():
+            self._transport.close()
+        else:
+            self._transport.resume_reading()
+            self._next_request()
+
+    def _send_head(self, status, headers, keep_alive):
+        response = HttpResponse(status)
+        for key, value in headers.items():
+            response.add_header(key, value)
+        if not keep_alive:
+            response.add_header('Connection', 'close')
+        self.write((response.get_status() + response.get_headers() +
+                    '\r\n').encode())
+
+    async def _respond(self, head):
+        """ answer one request, return whether to keep the connection """
+        try:
+            method, _, version, headers = _parse_request(head)
+        except ValueError:
+            self._send_head(HTTPStatus.BAD_REQUEST, {'Content-Length': 0},
+                            False)
+            return False
+        _LOGGER.debug('[D] Content request %s', head)
+        connection = headers.get('connection', '').lower()
+        keep_alive = (connection != 'close' if version == 'HTTP/1.1' else
+                      connection == 'keep-alive')
+        # request bodies are not expected, and not skipped
+        if 'content-length' in headers or 'transfer-encoding' in headers:
+            keep_alive = False
+
+        if method not in ('GET', 'HEAD'):
+            self._send_head(HTTPStatus.METHOD_NOT_ALLOWED, {
+                'Allow': 'GET, HEAD',
+                'Content-Length': 0
+            }, keep_alive)
+            return keep_alive
+
+        if isinstance(self._content, _StreamContent):
+            return await self._respond_stream(method, version, keep_alive)
+
+        size = self._content.size
+        response = {'Content-Type': self._content_type,
+                    'Accept-Ranges': 'bytes'}
+        status, start, end = HTTPStatus.OK, 0, size
+        byte_range = headers.get('range')
+        if byte_range:
+            byte_range = _parse_range(byte_range, size)
+        if byte_range:
+            start, end = byte_range
+            if start >= size:
+                response = {'Content-Range': 'bytes */{}'.format(size),
+                            'Content-Length': 0}
+                self._send_head(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                                response, keep_alive)
+                return keep_alive
+            status = HTTPStatus.PARTIAL_CONTENT
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, end - 1, size)
+        response['Content-Length'] = end - start
+        self._send_head(status, response, keep_alive)
+        if method == 'GET':
+            await self._content.send(self, start, end)
+        return keep_alive
+
+    async def _respond_stream(self, method, version, keep_alive):
+        """ answer with the streamed content """
+        chunked = version == 'HTTP/1.1'
+        # without chunked encoding the end is told by closing
+        keep_alive = keep_alive and chunked
+        response = {'Content-Type': self._content_type,
+                    'Accept-Ranges': 'none'}
+        if chunked:
+            response['Transfer-Encoding'] = 'chunked'
+        if method == 'HEAD':
+            self._send_head(HTTPStatus.OK, response, keep_alive)
+            return keep_alive
+        chunks = self._content.take()
+        if chunks is None:
+            self._send_head(HTTPStatus.GONE, {'Content-Length': 0},
+                            keep_alive)
+            return keep_alive
+        self._send_head(HTTPStatus.OK, response, keep_alive)
+        await self._content.send(self, chunks, chunked)
+        return keep_alive
+
+
+# shared by AioHeosUpnp instances not given caches of their own
+_DISCOVERY_CACHE = DiscoveryCache()
+_DESCRIPTION_CACHE = DescriptionCache()
 
-class AioHeosUpnp():
-    " Heos version of Upnp "
 
-    def __init__(self, loop):
+class AioHeosUpnp():
+    """ Heos version of Upnp
+
+    Discovery results are kept in cache, a DiscoveryCache, and device
+    descriptions in descriptions, a DescriptionCache, by default the ones
+    shared by all instances. Cached results are used right away while a
+    new search runs in the background every refresh seconds. Soap actions
+    and description fetches share one http session keeping connections
+    alive, closed by close() unless session was given. With host set,
+    discover only finds the device at host.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, loop, cache=None, refresh=DISCOVERY_REFRESH,
+                 mx=DISCOVERY_MX, session=None, descriptions=None,
+                 host=None):
         self._loop = loop
+        self._host = host
+        # addresses of host, once resolved
+        self._addresses = None if host is None else set()
         self._upnp = None
+        self._session = session
         self._url = None
         self._path = None
         self._renderer_uri = None
+        self._cache = cache if cache is not None else _DISCOVERY_CACHE
+        self._descriptions = (descriptions if descriptions is not None else
+                              _DESCRIPTION_CACHE)
+        self._refresh = refresh
+        self._mx = mx
+        self._search_task = None
+        self._content_server = None
+        self._waiters = []
+
+    def _search(self):
+        """ start a search unless one is running """
+        if not self._upnp:
+            self._upnp = Upnp(loop=self._loop, session=self._session)
+        if self._search_task is None or self._search_task.done():
+            self._search_task = self._loop.create_task(
+                self._upnp.search(DENON_DEVICE, self._mx, self._on_device))
+            self._search_task.add_done_callback(self._searched)
+        return self._search_task
+
+    def _matches(self, device):
+        return self._addresses is None or device.host in self._addresses
+
+    async def _resolve(self):
+        """ resolve host, devices announce themselves by address """
+        if not self._addresses:
+            self._addresses.update(await resolve(self._loop, self._host))
+
+    def _on_device(self, device):
+        if not self._matches(device):
+            return
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(device)
+
+    def _searched(self, task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            _LOGGER.warning('[W] Discovery failed: %s', task.exception())
+            return
+        self._cache.update(task.result())
+        for device in task.result():
+            self._descriptions.observe(device)
+
+    def _cached(self):
+        """ return cached devices, refresh them if due """
+        devices = self._cache.devices(DENON_DEVICE)
+        if devices and (self._cache.searched_at is None or time.time() -
+                        self._cache.searched_at >= self._refresh):
+            self._search()
+        return devices
+
+    @property
+    def descriptions(self):
+        """ DescriptionCache in use """
+        return self._descriptions
+
+    async def discover_all(self):
+        """ discover every device, return a list of SsdpDevice """
+        devices = self._cached()
+        if devices:
+            return devices
+        return await self._search()
 
     async def discover(self):
-        " discover "
-        if not self._upnp:
-            self._upnp = Upnp(loop=self._loop)
-        self._url = await self._upnp.discover(DENON_DEVICE)
+        " discover, return the location of one device, the one at host "
+        if self._addresses is not None:
+            await self._resolve()
+        devices = [
+            device for device in self._cached() if self._matches(device)
+        ]
+        if devices:
+            self._url = devices[0].location
+            return self._url
+        # no need to wait for the others
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait([waiter, self._search()],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._waiters.remove(waiter)
+        if not waiter.done():
+            waiter.cancel()
+            if self._host is not None:
+                raise UpnpException(
+                    'No Heos device found at {}'.format(self._host))
+            raise UpnpException('No Heos device found')
+        self._url = waiter.result().location
         return self._url
 
+    async def close(self):
+        " close "
+        if self._search_task:
+            self._search_task.cancel()
+        await self._stop_content()
+        if self._upnp:
+            await self._upnp.close()
+
     async def query_renderer(self):
         " query renderer "
-        if not self._url or not self._upnp:
+        if not self._url:
             return
-        self._path = await self._upnp.query_renderer(
-            AVTRANSPORT_SERVICE, self._url)
-        self._renderer_uri = self._url + self._path
+        if not self._upnp:
+            self._upnp = Upnp(loop=self._loop, session=self._session)
+        device = next((device for device in self._cache.devices()
+                       if device.location == self._url), None)
+        description = await self._upnp.query_description(
+            self._url, self._descriptions, device)
+        self._path = description.services.get(AVTRANSPORT_SERVICE,
+                                              {}).get('controlURL')
+        self._renderer_uri = description.service_url(AVTRANSPORT_SERVICE)
 
     async def _play_uri(self, uri):
         " play an url "
         if not self._url:
             await self.discover()
-        if not self._renderer_uri:
-            await self.query_renderer()
+        # cheap once cached, and picks up a reboot of the device
+        await self.query_renderer()
         await self._upnp.set_avtransport_uri(uri, self._renderer_uri)
         await self._upnp.set_play(self._renderer_uri)
 
+    async def _stop_content(self):
+        if self._content_server:
+            self._content_server.close()
+            await self._content_server.wait_closed()
+            self._content_server = None
+
     async def play_content(self, content, content_type='audio/mpeg', port=0):
-        " play "
+        """ play content, see PlayContentServer
+
+        content is served until the next play_content or close.
+        """
         address = _get_ipaddress()
+        await self._stop_content()
+        content = _content_source(content)
 
         # create a listening port
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -404,15 +1271,13 @@ class AioHeosUpnp():
         uri = 'http://{}:{}/dummy.mp3'.format(address, port)
 
         # http server
-        http_server = self._loop.create_server(
+        self._content_server = await self._loop.create_server(
             lambda: PlayContentServer(content, content_type),
             sock=sock
         )
 
         # play request
-        play_uri = self._loop.create_task(self._play_uri(uri))
-
-        await asyncio.wait([http_server, play_uri])
+        await self._play_uri(uri)
 
 
 async def main(aioloop):    # pylint: disable=redefined-outer-name
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Heos python lib benchmarks."""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+import aioheos
+from aioheos import aioheosupnp
+
+PLAYERS = [{'name': 'Player {}'.format(pid), 'pid': pid, 'ip': '127.0.0.1'}
+           for pid in range(1, 21)]
+
+
+def _event(command, message):
+    return (json.dumps({'heos': {'command': command, 'message': message}})
+            + '\r\n').encode()
+
+
+def _event_lines(count):
+    """Mix of events as seen from a house with 20 playing speakers."""
+    lines = []
+    for i in range(count):
+        pid = PLAYERS[i % len(PLAYERS)]['pid']
+        if i % 10 == 9:
+            lines.append(_event('event/player_volume_changed',
+                                'pid={}&level={}&mute=off'.format(
+                                    pid, i % 100)))
+        elif i % 10 == 8:
+            lines.append(_event('event/player_state_changed',
+                                'pid={}&state=play'.format(pid)))
+        else:
+            lines.append(_event('event/player_now_playing_progress',
+                                'pid={}&cur_pos={}&duration=240000'.format(
+                                    pid, i * 1000)))
+    return lines
+
+
+async def bench_dispatch(loop, count=100000):
+    """Messages/second through _async_subscribe -> _dispatcher."""
+    heos = aioheos.AioHeosController(loop, host='127.0.0.1')
+    heos._parse_players(PLAYERS, {})    # pylint: disable=protected-access
+
+    done = loop.create_future()
+    heos.register_handler('bench/done',
+                          lambda _payload, _message: done.set_result(None))
+
+    reader = asyncio.StreamReader(limit=2**24)
+    reader.feed_data(b''.join(_event_lines(count)))
+    reader.feed_data(_event('bench/done', ''))
+    # pylint: disable=protected-access
+    connection = heos._event_connection
+    connection.reader = reader
+
+    start = time.perf_counter()
+    task = loop.create_task(heos._async_subscribe(connection))
+    await done
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    await heos.close()
+
+    print('dispatch: {:.0f} messages/s'.format(count / elapsed))
+
+
+STUB_MESSAGES = {
+    b'player/get_play_state': b'&state=play',
+    b'player/get_mute': b'&state=off',
+    b'player/get_volume': b'&level=10',
+}
+STUB_PAYLOADS = {
+    b'player/get_players': b', "payload": []',
+    b'group/get_groups': b', "payload": []',
+    b'player/get_now_playing_media': b', "payload": {"song": "Song"}',
+}
+PROGRESS = _event('event/player_now_playing_progress',
+                  'pid=1&cur_pos=1000&duration=240000')
+
+
+class StubServer(asyncio.Protocol):
+    """Heos CLI stub answering every command with success.
+
+    With flood set, every read first sends that many progress events on
+    each connection registered for events.
+    """
+
+    reads = 0
+    flood = 0
+    registered = set()
+
+    def __init__(self):
+        self._transport = None
+        self._buffer = b''
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def connection_lost(self, exc):
+        StubServer.registered.discard(self._transport)
+
+    def data_received(self, data):
+        StubServer.reads += 1
+        if StubServer.flood:
+            for transport in StubServer.registered:
+                transport.write(PROGRESS * StubServer.flood)
+        lines = (self._buffer + data).split(b'\r\n')
+        self._buffer = lines.pop()
+        replies = []
+        for line in lines:
+            command, _, message = line[len(b'heos://'):].partition(b'?')
+            if command == b'system/register_for_change_events':
+                StubServer.registered.add(self._transport)
+            replies.append(
+                b'{"heos": {"command": "%s", "result": "success", '
+                b'"message": "%s%s"}%s}\r\n' % (
+                    command, message, STUB_MESSAGES.get(command, b''),
+                    STUB_PAYLOADS.get(command, b'')))
+        self._transport.write(b''.join(replies))
+
+
+async def bench_commands(loop, bursts=5000):
+    """Commands/second and writes per burst of request_update commands."""
+    server = await loop.create_server(StubServer, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    heos = aioheos.AioHeosController(loop, host='127.0.0.1', port=port)
+    heos._parse_players(PLAYERS, {})    # pylint: disable=protected-access
+    await heos.connect()
+
+    writes = 0
+
+    def counting(write):
+        def counting_write(data):
+            nonlocal writes
+            writes += 1
+            write(data)
+        return counting_write
+
+    for connection in heos._connections:    # pylint: disable=protected-access
+        connection.writer.write = counting(connection.writer.write)
+    StubServer.reads = 0
+
+    start = time.perf_counter()
+    for i in range(bursts):
+        pid = PLAYERS[i % len(PLAYERS)]['pid']
+        await asyncio.gather(heos.request_play_state(pid),
+                             heos.request_mute_state(pid),
+                             heos.request_volume(pid),
+                             heos.request_now_playing_media(pid))
+    elapsed = time.perf_counter() - start
+    await heos.close()
+    server.close()
+
+    print('commands: {:.0f} commands/s, {:.2f} writes and {:.2f} server '
+          'reads per burst of 4'.format(bursts * 4 / elapsed,
+                                        writes / bursts,
+                                        StubServer.reads / bursts))
+
+
+async def bench_flood(loop, command_connections, count=500, flood=200):
+    """Reply latency of commands while the event connection is flooded."""
+    server = await loop.create_server(StubServer, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    heos = aioheos.AioHeosController(loop, host='127.0.0.1', port=port,
+                                     command_connections=command_connections)
+    heos._parse_players(PLAYERS, {})    # pylint: disable=protected-access
+    await heos.connect()
+
+    StubServer.flood = flood
+    latencies = []
+    for i in range(count):
+        pid = PLAYERS[i % len(PLAYERS)]['pid']
+        start = time.perf_counter()
+        await heos.request_volume(pid)
+        latencies.append(time.perf_counter() - start)
+    StubServer.flood = 0
+    await heos.close()
+    server.close()
+
+    latencies.sort()
+    print('flood, {} command connections: {:.2f} ms median, {:.2f} ms p99 '
+          'reply latency'.format(command_connections,
+                                 latencies[len(latencies) // 2] * 1000,
+                                 latencies[len(latencies) * 99 // 100] * 1000))
+
+
+async def bench_priority(loop, queued=1000):
+    """Latency of a pause queued after a batch of browse commands."""
+    server = await loop.create_server(StubServer, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    heos = aioheos.AioHeosController(loop, host='127.0.0.1', port=port)
+    heos._parse_players(PLAYERS, {})    # pylint: disable=protected-access
+    await heos.connect()
+
+    for name, priority in (('fifo', aioheos.PRIORITY_BACKGROUND),
+                           ('priority', None)):
+        browse = [heos.request_browse_source(i) for i in range(queued)]
+        start = time.perf_counter()
+        await heos.send_command('player/set_play_state', {
+            'pid': 1,
+            'state': 'pause'
+        }, priority=priority)
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*browse)
+        print('{}: pause answered after {:.2f} ms behind {} browse '
+              'commands'.format(name, elapsed * 1000, queued))
+    await heos.close()
+    server.close()
+
+
+async def bench_soap(loop, actions=500):
+    """Soap actions/second against a stub renderer."""
+    connections = set()
+
+    async def control(request):
+        connections.add(request.transport)
+        await request.read()
+        return web.Response(
+            body=b'<s:Envelope><s:Body><u:PlayResponse/></s:Body>'
+            b'</s:Envelope>',
+            content_type='text/xml')
+
+    app = web.Application()
+    app.router.add_post('/AVTransport/ctrl', control)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    # pylint: disable=protected-access
+    url = 'http://127.0.0.1:{}/AVTransport/ctrl'.format(
+        site._server.sockets[0].getsockname()[1])
+
+    upnp = aioheosupnp.Upnp(loop)
+    for name, pooled in (('new session per action', False),
+                         ('pooled session', True)):
+        connections.clear()
+        start = time.perf_counter()
+        for _ in range(actions):
+            await upnp.set_play(url)
+            if not pooled:
+                await upnp.close()
+        elapsed = time.perf_counter() - start
+        print('soap, {}: {:.0f} actions/s, {} connections'.format(
+            name, actions / elapsed, len(connections)))
+    await upnp.close()
+    await runner.cleanup()
+
+
+DESCRIPTION = b'''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0"><device><UDN>uuid:bench</UDN>
+<serviceList><service>
+<serviceType>urn:schemas-upnp-org:service:AVTransport:1</serviceType>
+<controlURL>/AVTransport/ctrl</controlURL>
+<eventSubURL>/AVTransport/event</eventSubURL>
+<SCPDURL>/AVTransport.xml</SCPDURL>
+</service></serviceList></device></root>'''
+
+
+async def bench_description(loop, queries=500):
+    """Renderer lookups/second, fetching the description or cached."""
+    async def description(_request):
+        return web.Response(body=DESCRIPTION, content_type='text/xml')
+
+    app = web.Application()
+    app.router.add_get('/description.xml', description)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    # pylint: disable=protected-access
+    url = 'http://127.0.0.1:{}/description.xml'.format(
+        site._server.sockets[0].getsockname()[1])
+
+    upnp = aioheosupnp.Upnp(loop)
+    for name, cache in (('fetched', None),
+                        ('cached', aioheosupnp.DescriptionCache())):
+        start = time.perf_counter()
+        for _ in range(queries):
+            await upnp.query_renderer(aioheosupnp.AVTRANSPORT_SERVICE, url,
+                                      cache)
+        elapsed = time.perf_counter() - start
+        print('description, {}: {:.0f} lookups/s'.format(
+            name, queries / elapsed))
+    await upnp.close()
+    await runner.cleanup()
+
+
+async def bench_content(loop, size=2**26):
+    """Throughput and memory serving content, from memory or a file."""
+    path = os.path.join(tempfile.mkdtemp(), 'content.bin')
+    with open(path, 'wb') as fcontent:
+        fcontent.write(os.urandom(size))
+
+    for name, content in (('file', path), ('memory', None)):
+        tracemalloc.start()
+        if content is None:
+            with open(path, 'rb') as fcontent:
+                content = fcontent.read()
+        server = await loop.create_server(
+            lambda: aioheosupnp.PlayContentServer(content, 'audio/mpeg'),
+            '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        start = time.perf_counter()
+        writer.write(b'GET /content HTTP/1.1\r\nConnection: close\r\n\r\n')
+        received = 0
+        while True:
+            data = await reader.read(2**16)
+            if not data:
+                break
+            received += len(data)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        del content
+        print('content, {}: {:.0f} MB/s, {:.1f} MB peak memory'.format(
+            name, received / elapsed / 2**20, peak / 2**20))
+    os.remove(path)
+
+
+def main():
+    """Main."""
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(bench_dispatch(loop))
+        loop.run_until_complete(bench_commands(loop))
+        loop.run_until_complete(bench_flood(loop, 0))
+        loop.run_until_complete(bench_flood(loop, 2))
+        loop.run_until_complete(bench_priority(loop))
+        loop.run_until_complete(bench_soap(loop))
+        loop.run_until_complete(bench_description(loop))
+        loop.run_until_complete(bench_content(loop))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
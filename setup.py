@@ -17,6 +17,9 @@ setup(name='aioheos',
           'lxml',
           'pytz'
       ],
+      extras_require={
+          'orjson': ['orjson']
+      },
       classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
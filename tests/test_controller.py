@@ -0,0 +1,407 @@
+"""AioHeosController tests against a stub Heos device."""
+
+import asyncio
+import json
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+
+import aioheos
+from aioheos import aioheosupnp
+
+PLAYERS = [{'name': 'Player 1', 'pid': 1, 'ip': '127.0.0.1'}]
+
+
+class StubDevice:
+    """Heos CLI stub answering commands in order, echoing the message.
+
+    delays maps commands to a list of delays for their next replies,
+    commands in drop are never answered and commands in under_process
+    are first answered with 'command under process'. groups is the
+    payload of get_groups, commands lists the commands received. Unless
+    echo_sequence is set, the SEQUENCE argument is not echoed, as by
+    older firmware.
+    """
+
+    def __init__(self):
+        self.echo_sequence = True
+        self.groups = []
+        self.commands = []
+        self.delays = {}
+        self.drop = set()
+        self.under_process = set()
+        self.writers = []
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        " start listening "
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1',
+                                                 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        " stop listening and drop all connections "
+        self.server.close()
+        for writer in self.writers:
+            writer.transport.abort()
+        await self.server.wait_closed()
+
+    def reset(self):
+        " drop all connections "
+        for writer in self.writers:
+            writer.transport.abort()
+        self.writers.clear()
+
+    def event(self, command, message):
+        " send an event on every connection "
+        for writer in self.writers:
+            writer.write(_line({'command': command, 'message': message}))
+
+    async def _handle(self, reader, writer):
+        self.writers.append(writer)
+        try:
+            await self._serve(reader, writer)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def _serve(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            url = urlsplit(line.decode().strip())
+            command = url.netloc + url.path
+            message = url.query
+            self.commands.append(command)
+            if not self.echo_sequence:
+                message = '&'.join(
+                    argument for argument in message.split('&')
+                    if not argument.startswith('SEQUENCE='))
+            if command in self.drop:
+                continue
+            if command in self.under_process:
+                writer.write(_line({
+                    'command': command,
+                    'result': 'success',
+                    'message': 'command under process&' + message
+                }))
+            delays = self.delays.get(command)
+            if delays:
+                await asyncio.sleep(delays.pop(0))
+            writer.write(self._reply(command, message))
+
+    def _reply(self, command, message):
+        payload = None
+        if command == 'player/get_players':
+            payload = PLAYERS
+        elif command == 'group/get_groups':
+            payload = self.groups
+        if command == 'player/get_volume':
+            message += '&level=10'
+        return _line({
+            'command': command,
+            'result': 'success',
+            'message': message
+        }, payload)
+
+
+def _line(heos, payload=None):
+    data = {'heos': heos}
+    if payload is not None:
+        data['payload'] = payload
+    return (json.dumps(data) + '\r\n').encode()
+
+
+def _run(scenario, **options):
+    """Run scenario(stub, heos) against a connected controller."""
+
+    options.setdefault('host', '127.0.0.1')
+
+    async def run():
+        stub = await StubDevice().start()
+        heos = aioheos.AioHeosController(asyncio.get_event_loop(),
+                                         port=stub.port, **options)
+        await heos.connect()
+        try:
+            await asyncio.wait_for(scenario(stub, heos), 10)
+        finally:
+            await heos.close()
+            await stub.stop()
+
+    asyncio.run(run())
+
+
+def test_late_reply_not_taken_by_next_command():
+    """Reply to a timed out command does not resolve the next one."""
+
+    async def scenario(stub, heos):
+        stub.delays['player/set_volume'] = [0.25]
+        with pytest.raises(aioheos.AioHeosException):
+            await heos.set_volume(10, 1)
+        reply = await heos.set_volume(20, 1)
+        assert reply.message['level'] == '20'
+        assert heos.get_player(1).volume == 20
+        assert not heos._pending    # pylint: disable=protected-access
+
+    _run(scenario, command_timeout=0.2)
+
+
+def test_cancelled_command_absorbs_its_reply():
+    """Reply to a cancelled command does not resolve the next one."""
+
+    async def scenario(stub, heos):
+        stub.delays['player/set_volume'] = [0.1]
+        first = heos.set_volume(10, 1)
+        await asyncio.sleep(0.05)
+        first.cancel()
+        reply = await heos.set_volume(20, 1)
+        assert reply.message['level'] == '20'
+
+    _run(scenario)
+
+
+def test_under_process_resend_absorbs_both_replies():
+    """A command resent after 'command under process' resolves once."""
+
+    async def scenario(stub, heos):
+        stub.under_process.add('player/set_play_state')
+        stub.delays['player/set_play_state'] = [0.3, 0.1]
+        reply = await heos.play(1)
+        assert reply.message['state'] == 'play'
+        stub.under_process.clear()
+        reply = await heos.pause(1)
+        assert reply.message['state'] == 'pause'
+        await asyncio.sleep(0.1)
+        assert not heos._pending    # pylint: disable=protected-access
+
+    _run(scenario, command_timeout=0.25)
+
+
+def test_deadline_covers_time_queued_behind_full_window():
+    """Commands waiting for a window slot time out as well."""
+
+    async def scenario(stub, heos):
+        stub.drop.add('player/get_volume')
+        start = time.monotonic()
+        results = await asyncio.gather(heos.request_volume(1),
+                                       heos.request_volume(1),
+                                       return_exceptions=True)
+        assert all(
+            isinstance(result, aioheos.AioHeosException)
+            for result in results)
+        assert time.monotonic() - start < 0.35
+
+    _run(scenario, command_timeout=0.2, max_in_flight=1)
+
+
+def test_deadline_covers_time_queued_while_reconnecting():
+    """Commands queued while the connection is down time out."""
+
+    async def scenario(stub, heos):
+        await stub.stop()
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        with pytest.raises(aioheos.AioHeosException):
+            await heos.set_volume(10, 1)
+        assert time.monotonic() - start < 0.5
+
+    _run(scenario, command_timeout=0.2)
+
+
+def test_reconnect_fails_in_flight_commands_and_recovers():
+    """In-flight commands fail once the connection is lost, later ones
+    are sent on the new connection."""
+
+    async def scenario(stub, heos):
+        stub.drop.add('player/get_volume')
+        future = heos.request_volume(1)
+        await asyncio.sleep(0.05)
+        stub.reset()
+        with pytest.raises(aioheos.AioHeosException) as exc:
+            await future
+        assert exc.value.message == 'Connection lost'
+        stub.drop.clear()
+        reply = await heos.request_volume(1)
+        assert reply.message['level'] == '10'
+        assert heos.stats()['reconnects'] == 1
+
+    _run(scenario, command_timeout=5)
+
+
+def test_dissolved_group_is_forgotten():
+    """Events for a player do not bring a dissolved group back."""
+
+    async def scenario(stub, heos):
+        stub.groups = [{'name': 'Group 1', 'gid': 1,
+                        'players': [{'pid': 1, 'role': 'leader'}]}]
+        await heos.request_groups()
+        group = heos.get_group(1)
+        assert group is not None
+        stub.groups = []
+        await heos.request_groups()
+        assert heos.get_group(1) is None
+        assert heos.get_groups() == []
+        stub.event('event/player_state_changed', 'pid=1&state=play')
+        await asyncio.sleep(0.05)
+        assert heos.get_player(1).play_state == 'play'
+        assert group.play_state is None
+
+    _run(scenario)
+
+
+def test_heart_beats_on_fixed_cadence():
+    """Heart beats are sent every interval, however long the answer
+    takes."""
+
+    async def scenario(stub, heos):
+        stub.delays['system/heart_beat'] = [0.08] * 20
+        del stub.commands[:]
+        await asyncio.sleep(1.05)
+        assert stub.commands.count('system/heart_beat') >= 9
+
+    _run(scenario, heartbeat_interval=0.1)
+
+
+def test_missed_heart_beats_reconnect_with_full_window():
+    """A link which stopped answering is detected within a few beats,
+    even with the in-flight window full."""
+
+    async def scenario(stub, heos):
+        stub.drop.update(('player/get_volume', 'system/heart_beat'))
+        futures = [heos.request_volume(1) for _ in range(4)]
+        start = time.monotonic()
+        while not heos.stats()['reconnects']:
+            await asyncio.sleep(0.05)
+        assert time.monotonic() - start < 1.5
+        for future in futures:
+            with pytest.raises(aioheos.AioHeosException):
+                await future
+
+    _run(scenario, heartbeat_interval=0.3, heartbeat_misses=2,
+         max_in_flight=4, command_timeout=30)
+
+
+def test_heart_beats_pass_full_window():
+    """Heart beats are written and answered with the window full."""
+
+    async def scenario(stub, heos):
+        stub.drop.add('player/get_volume')
+        futures = [heos.request_volume(1) for _ in range(4)]
+        await asyncio.sleep(1)
+        assert not heos.stats()['reconnects']
+        assert heos.rtt is not None
+        for future in futures:
+            future.cancel()
+
+    _run(scenario, heartbeat_interval=0.2, heartbeat_misses=2,
+         max_in_flight=4, command_timeout=30)
+
+
+def test_only_heos_devices_arriving_refresh_players():
+    """Other media renderers arriving do not refresh the players."""
+
+    async def scenario(stub, heos):
+        del stub.commands[:]
+        # pylint: disable=protected-access
+        heos._device_arrived(
+            aioheosupnp.SsdpDevice('uuid:tv', aioheosupnp.MEDIA_DEVICE,
+                                   'http://10.0.0.9:8080/tv.xml', 0))
+        await asyncio.sleep(0.05)
+        assert 'player/get_players' not in stub.commands
+        heos._device_arrived(
+            aioheosupnp.SsdpDevice('uuid:heos', aioheosupnp.DENON_DEVICE,
+                                   'http://10.0.0.8:60006/heos.xml', 0))
+        await asyncio.sleep(0.05)
+        assert 'player/get_players' in stub.commands
+
+    _run(scenario)
+
+
+def test_lost_reply_does_not_fail_later_commands():
+    """A command the device never answers does not take the replies to
+    later commands with the same key."""
+
+    async def scenario(stub, heos):
+        stub.drop.add('player/get_volume')
+        with pytest.raises(aioheos.AioHeosException):
+            await heos.request_volume(1)
+        stub.drop.clear()
+        for _ in range(3):
+            reply = await heos.request_volume(1)
+            assert reply.message['level'] == '10'
+
+    _run(scenario, command_timeout=0.3)
+
+
+def test_lost_reply_without_sequence_fails_later_commands_for_a_while():
+    """Without sequences in replies, a command the device never answers
+    takes replies to later ones for one timeout at most."""
+
+    async def scenario(stub, heos):
+        stub.echo_sequence = False
+        stub.drop.add('player/get_volume')
+        with pytest.raises(aioheos.AioHeosException):
+            await heos.request_volume(1)
+        stub.drop.clear()
+        await asyncio.sleep(0.35)
+        reply = await heos.request_volume(1)
+        assert reply.message['level'] == '10'
+
+    _run(scenario, command_timeout=0.3)
+
+
+def test_device_arriving_at_host_name_retries_connection():
+    """Announcements are matched with the resolved host name."""
+
+    async def scenario(_stub, heos):
+        # pylint: disable=protected-access
+        heos._connect_now.clear()
+        heos._device_arrived(
+            aioheosupnp.SsdpDevice('uuid:heos', aioheosupnp.MEDIA_DEVICE,
+                                   'http://127.0.0.1:60006/heos.xml', 0))
+        assert heos._connect_now.is_set()
+
+    _run(scenario, host='localhost', ssdp_listen=True)
+
+
+def test_proxy_shares_reads_and_fans_out_events():
+    """Two proxy clients asking for players at once cause one command to
+    the device, both get the reply and both get events."""
+
+    async def scenario(stub, heos):
+        proxy = aioheos.AioHeosProxy(asyncio.get_event_loop(), heos,
+                                     host='127.0.0.1', port=0)
+        await proxy.start()
+        clients = []
+        try:
+            for _ in range(2):
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', proxy.port)
+                writer.write(b'heos://system/register_for_change_events'
+                             b'?enable=on\r\n')
+                await reader.readline()
+                clients.append((reader, writer))
+            stub.commands.clear()
+            stub.delays['player/get_players'] = [0.1]
+            for _, writer in clients:
+                writer.write(b'heos://player/get_players\r\n')
+            for reader, _ in clients:
+                reply = json.loads(await reader.readline())
+                assert reply['heos']['command'] == 'player/get_players'
+                assert reply['payload'] == PLAYERS
+            assert stub.commands.count('player/get_players') == 1
+            stub.event('event/player_volume_changed',
+                       'pid=1&level=5&mute=off')
+            for reader, _ in clients:
+                event = json.loads(await reader.readline())
+                assert event['heos']['command'] == (
+                    'event/player_volume_changed')
+        finally:
+            for _, writer in clients:
+                writer.close()
+            await proxy.close()
+
+    _run(scenario)
@@ -0,0 +1,55 @@
+"""AioHeosPlayer tests."""
+
+from aioheos import aioheosplayer
+
+
+class StubController:
+    """Controller recording the players marked changed."""
+
+    def __init__(self):
+        self.changed = []
+
+    def _mark_changed(self, player):
+        self.changed.append(player)
+
+
+def _player():
+    controller = StubController()
+    return controller, aioheosplayer.AioHeosPlayer(controller, {'pid': 1})
+
+
+def test_failing_subscriber_does_not_stop_others():
+    """Subscribers and listeners are called even if one raises."""
+    controller, player = _player()
+    calls = []
+
+    def failing(_player, _field, _old, _new):
+        raise RuntimeError('subscriber')
+
+    player.subscribe('volume', failing)
+    player.subscribe('volume', lambda *args: calls.append(args[1:]))
+    player.state_change_callback = lambda: calls.append('callback')
+    player.volume = 10
+    assert calls == [('volume', 0, 10), 'callback']
+    assert controller.changed == [player]
+
+
+def test_failing_state_change_callback_is_isolated():
+    """A raising state change callback does not reach the caller."""
+    controller, player = _player()
+
+    def failing():
+        raise RuntimeError('callback')
+
+    player.state_change_callback = failing
+    player.volume = 10
+    assert controller.changed == [player]
+
+
+def test_unsubscribe_drops_empty_fields():
+    """No subscribers are left behind once all unsubscribed."""
+    _, player = _player()
+    unsubscribe = player.subscribe('media_*', lambda *args: None)
+    unsubscribe()
+    unsubscribe()
+    assert not player._subscribers    # pylint: disable=protected-access
@@ -0,0 +1,178 @@
+"""aioheosupnp tests."""
+
+import asyncio
+
+from aioheos import aioheosupnp
+
+
+def _notify(uuid, notification_type, nts='ssdp:alive'):
+    return ('NOTIFY * HTTP/1.1\r\n'
+            'HOST: 239.255.255.250:1900\r\n'
+            'CACHE-CONTROL: max-age=1800\r\n'
+            'LOCATION: http://10.0.0.1:60006/description.xml\r\n'
+            'NT: {nt}\r\n'
+            'NTS: {nts}\r\n'
+            'USN: {uuid}::{nt}\r\n\r\n').format(uuid=uuid,
+                                                nt=notification_type,
+                                                nts=nts).encode()
+
+
+def test_notify_arrival_and_departure_per_type():
+    """A device announcing both types arrives and departs once per type."""
+
+    async def run():
+        arrived = []
+        departed = []
+        protocol = aioheosupnp.Upnp.NotifyProtocol(
+            asyncio.get_event_loop(),
+            (aioheosupnp.DENON_DEVICE, aioheosupnp.MEDIA_DEVICE),
+            arrived.append, departed.append)
+        for notification_type in (aioheosupnp.MEDIA_DEVICE,
+                                  aioheosupnp.DENON_DEVICE,
+                                  aioheosupnp.MEDIA_DEVICE):
+            protocol.datagram_received(
+                _notify('uuid:A', notification_type), None)
+        assert [device.search_target for device in arrived] == [
+            aioheosupnp.MEDIA_DEVICE, aioheosupnp.DENON_DEVICE
+        ]
+        protocol.datagram_received(
+            _notify('uuid:A', aioheosupnp.DENON_DEVICE, 'ssdp:byebye'), None)
+        assert [device.search_target for device in departed] == [
+            aioheosupnp.DENON_DEVICE
+        ]
+        protocol.connection_lost(None)
+
+    asyncio.run(run())
+
+
+CONTENT = bytes(range(100))
+
+
+async def _serve(content):
+    return await asyncio.get_event_loop().create_server(
+        lambda: aioheosupnp.PlayContentServer(content, 'audio/mpeg'),
+        '127.0.0.1', 0)
+
+
+async def _read_response(reader, method='GET'):
+    """Return status, headers and body of one response."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    if method == 'HEAD':
+        return status, headers, b''
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int(await reader.readuntil(b'\r\n'), 16)
+            chunk = await reader.readexactly(size + 2)
+            if not size:
+                break
+            body += chunk[:-2]
+    else:
+        body = await reader.read()
+    return status, headers, body
+
+
+async def _request(server, data, methods):
+    """Send data, return the responses to methods and whether the
+    connection was closed after them."""
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    responses = []
+    for method in methods:
+        responses.append(await _read_response(reader, method))
+    closed = await reader.read() == b''
+    writer.close()
+    return responses, closed
+
+
+def test_content_ranges():
+    """A suffix range is served partially, one past the end is refused."""
+
+    async def run():
+        server = await _serve(CONTENT)
+        responses, closed = await _request(
+            server, b'GET / HTTP/1.1\r\nRange: bytes=-5\r\n\r\n'
+            b'GET / HTTP/1.1\r\nRange: bytes=100-\r\n'
+            b'Connection: close\r\n\r\n', ('GET', 'GET'))
+        server.close()
+        status, headers, body = responses[0]
+        assert status == 206
+        assert headers['content-range'] == 'bytes 95-99/100'
+        assert body == CONTENT[-5:]
+        status, headers, body = responses[1]
+        assert status == 416
+        assert headers['content-range'] == 'bytes */100'
+        assert body == b''
+        assert closed
+
+    asyncio.run(run())
+
+
+def test_content_head_then_get_pipelined():
+    """A HEAD and a GET sent together are answered in turn."""
+
+    async def run():
+        server = await _serve(CONTENT)
+        responses, closed = await _request(
+            server, b'HEAD / HTTP/1.1\r\n\r\n'
+            b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n', ('HEAD', 'GET'))
+        server.close()
+        assert [response[0] for response in responses] == [200, 200]
+        assert responses[0][1]['content-length'] == '100'
+        assert responses[1][2] == CONTENT
+        assert closed
+
+    asyncio.run(run())
+
+
+async def _chunks():
+    for offset in range(0, len(CONTENT), 30):
+        yield CONTENT[offset:offset + 30]
+
+
+def test_content_stream_http11_chunked():
+    """A stream is sent chunked over http/1.1, and only once."""
+
+    async def run():
+        server = await _serve(_chunks())
+        responses, closed = await _request(
+            server, b'GET / HTTP/1.1\r\n\r\n'
+            b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n', ('GET', 'GET'))
+        server.close()
+        status, headers, body = responses[0]
+        assert status == 200
+        assert headers['transfer-encoding'] == 'chunked'
+        assert body == CONTENT
+        assert responses[1][0] == 410
+        assert closed
+
+    asyncio.run(run())
+
+
+def test_content_stream_http10_until_close():
+    """A stream is sent as is over http/1.0, its end told by closing."""
+
+    async def run():
+        server = await _serve(_chunks())
+        responses, closed = await _request(
+            server, b'GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n',
+            ('GET', ))
+        server.close()
+        status, headers, body = responses[0]
+        assert status == 200
+        assert 'transfer-encoding' not in headers
+        assert headers['connection'] == 'close'
+        assert body == CONTENT
+        assert closed
+
+    asyncio.run(run())